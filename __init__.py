@@ -37,8 +37,8 @@ import sys
 import supybot
 from supybot import world
 
+from . import manifest
 from . import previewer
-from .previewers import generic
 # Use this for the version of this plugin.
 __version__ = '1.0'
 
@@ -59,12 +59,14 @@ if sys.version_info >= (3, 4):
 else:
     from imp import reload
 # In case we're being reloaded.
+# The previewer collections created by config and plugin need the new
+# manifest and previewer modules.
+reload(manifest)
+reload(previewer)
 reload(config)
 reload(plugin)
 # Add more reloads here if you add third-party modules and want them to be
 # reloaded when this plugin is reloaded.  Don't forget to import them as well!
-reload(generic)
-reload(previewer)
 
 
 if world.testing:
@@ -0,0 +1,114 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""HTTP client for the API previewers (YouTube, Twitter)
+
+If httpx and h2 are installed (pip install httpx[http2]), requests are
+made over HTTP/2, so concurrent lookups to an API host are multiplexed
+over a single connection. Otherwise, or when going through a proxy, or
+if HTTP/2 fails, requests are made over HTTP/1.1 with keep-alive. This is
+also the case while recording or replaying (see transport.py).
+"""
+
+import threading
+
+import requests
+
+# Optional support for HTTP/2 (httpx needs h2 for it)
+try:
+    import h2  # noqa: F401 pylint: disable=unused-import
+    import httpx
+except ImportError:
+    httpx = None
+
+from supybot import log
+
+from URLpreview import proxies, stats, transport
+
+HTTP2 = True   # Use HTTP/2 if available?
+TIMEOUT = 10
+
+_session = transport.session()
+_client = None
+_client_lock = threading.Lock()
+
+
+def http2_client():
+    """Returns the shared HTTP/2 client, or None if we can't do HTTP/2"""
+    global _client
+    if not HTTP2 or httpx is None or not transport.is_live():
+        return None  # Recording and replaying only works with requests
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = httpx.Client(http2=True, timeout=TIMEOUT)
+    return _client
+
+
+def get(url, headers=None, timeout=TIMEOUT):
+    """GETs <url>; the result has .status_code and .json() in any case"""
+    try:
+        return _get(url, headers, timeout)
+    except proxies.NoProxyAvailable as e:
+        log.info('URLpreview.api.get: %r' % e)
+        stats.incr('api_no_proxy')
+        # Previewers handle this like the API's own errors
+        r = requests.Response()
+        r.status_code = 503
+        r.reason = str(e)
+        r.url = url
+        return r
+
+
+def _get(url, headers, timeout):
+    with proxies.configured_pool().request() as proxy:
+        client = http2_client() if proxy is None else None
+        if client is not None:
+            try:
+                r = client.get(url, headers=headers, timeout=timeout)
+                stats.incr('api_requests %s' % r.http_version)
+                return r
+            except httpx.TimeoutException:
+                raise
+            except httpx.TransportError as e:
+                log.info('URLpreview.api.get: %r, retrying with HTTP/1.1' %
+                         e)
+                stats.incr('api_http2_fallbacks')
+        r = _session.get(url, headers=headers, timeout=timeout,
+                         proxies=proxy)
+        stats.incr('api_requests HTTP/1.1')
+        return r
+
+
+def close():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
@@ -0,0 +1 @@
+# Benchmarks, run them with python3 -m URLpreview.benchmarks.<name>
@@ -0,0 +1,67 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Measures canonical.canonicalize(), which runs on every URL posted.
+
+Run from the directory containing the plugin:
+    python3 -m URLpreview.benchmarks.canonical
+"""
+
+import timeit
+
+from URLpreview.canonical import canonicalize
+
+URLS = [
+    'https://example.com/',
+    'https://www.example.com/news/2020/10/01/some-long-article-slug.html',
+    'https://www.example.com/article?id=1234&utm_source=newsletter'
+    '&utm_medium=email&utm_campaign=october&fbclid=IwAR0abcdef',
+    'https://EXAMPLE.com:443/path/#section-2',
+    'https://youtu.be/dQw4w9WgXcQ?t=30',
+    'https://m.youtube.com/watch?feature=share&v=dQw4w9WgXcQ&t=30s',
+    'https://mobile.twitter.com/jack/status/20?s=20&ref_src=twsrc',
+    'https://twitter.com/jack',
+]
+NUMBER = 20000
+
+
+def main():
+    for url in URLS:
+        print('%s\n  -> %s' % (url, canonicalize(url)))
+    print()
+    total = 0
+    for url in URLS:
+        seconds = timeit.timeit(lambda: canonicalize(url), number=NUMBER)
+        total += seconds
+        print('%7.2f µs  %s' % (seconds / NUMBER * 1e6, url[:60]))
+    print('%7.2f µs  average' % (total / NUMBER / len(URLS) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
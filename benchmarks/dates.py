@@ -0,0 +1,79 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Compares dates.parse() with dateutil on typical date strings.
+
+The samples are the formats found in meta tags, JSON-LD, HTTP headers and
+the YouTube/Twitter APIs. Run from the directory containing the plugin:
+    python3 -m URLpreview.benchmarks.dates
+"""
+
+import timeit
+
+from dateutil.parser import parse as dateutil_parse
+
+from URLpreview import dates
+
+SAMPLES = [
+    '2020-10-01T12:34:56Z',                # YouTube API
+    '2020-10-01T12:34:56.000Z',            # Twitter API
+    '2020-10-01T14:34:56+02:00',           # article:published_time
+    '2020-10-01T14:34:56.123456+0200',
+    '2020-10-01 14:34:56',
+    '2020-10-01',                          # DC.Date
+    'Thu, 01 Oct 2020 12:34:56 GMT',       # HTTP Last-Modified
+    'Thu, 1 Oct 2020 14:34:56 +0200',      # RFC 2822
+    'October 1, 2020',                     # Odd ones go to dateutil
+]
+NUMBER = 2000
+
+
+def main():
+    for sample in SAMPLES:
+        ours = dates.parse(sample)
+        theirs = dateutil_parse(sample)
+        assert ours == theirs, (sample, ours, theirs)
+    print('%-36s %10s %10s %10s' % ('', 'dateutil', 'uncached', 'cached'))
+    totals = [0, 0, 0]
+    for sample in SAMPLES:
+        results = [
+            timeit.timeit(lambda: dateutil_parse(sample), number=NUMBER),
+            timeit.timeit(lambda: dates._parse.__wrapped__(sample),
+                          number=NUMBER),
+            timeit.timeit(lambda: dates.parse(sample), number=NUMBER),
+        ]
+        totals = [a + b for (a, b) in zip(totals, results)]
+        print('%-36s' % sample + ''.join(
+            '%8.2fµs' % (r / NUMBER * 1e6) for r in results))
+    print('%-36s' % 'average' + ''.join(
+        '%8.2fµs' % (r / NUMBER / len(SAMPLES) * 1e6) for r in totals))
+
+
+if __name__ == '__main__':
+    main()
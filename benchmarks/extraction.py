@@ -0,0 +1,91 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Compares extracting the metadata of a typical news article with the
+generic cascade (generic.get_meta()) and with a site profile (sites.py).
+
+Run from the directory containing the plugin:
+    python3 -m URLpreview.benchmarks.extraction
+"""
+
+import json
+import timeit
+
+from URLpreview import sites
+from URLpreview.previewers import generic
+
+RUNS = 20
+
+
+def make_page():
+    """Returns a page shaped like a news article: lots of <meta> tags and
+    JSON-LD in the <head>, a long body"""
+    ld_json = json.dumps({
+        '@context': 'https://schema.org', '@type': 'NewsArticle',
+        'headline': 'A headline', 'description': 'What happened',
+        'datePublished': '2020-10-01T12:00:00Z',
+        'author': [{'@type': 'Person', 'name': 'A. Writer'}],
+    })
+    head = ['<meta charset="utf-8">', '<title>A headline | Site</title>']
+    head += ['<meta name="tracking-%d" content="%d">' % (i, i)
+             for i in range(40)]
+    head += [
+        '<meta property="og:title" content="A headline">',
+        '<meta property="og:description" content="What happened, and why">',
+        '<meta property="article:published_time" '
+        'content="2020-10-01T12:00:00Z">',
+        '<script type="application/ld+json">%s</script>' % ld_json,
+    ]
+    head += ['<link rel="stylesheet" href="/style-%d.css">' % i
+             for i in range(20)]
+    body = ['<div class="column"><p>Paragraph %d with <a href="/%d">a link'
+            '</a> and <em>emphasis</em>.</p></div>' % (i, i)
+            for i in range(2000)]
+    return '<html><head>%s</head><body>%s</body></html>' % \
+        (''.join(head), ''.join(body))
+
+
+def main():
+    page = make_page()
+    profile = sites.find('www.theguardian.com')
+    generic_meta = generic.get_meta(page)
+    profile_meta = profile.extract(page)
+    assert generic_meta['title'] == profile_meta['title']
+    assert generic_meta['date'] == profile_meta['date']
+    print('page: %d KiB' % (len(page) // 1024))
+    for (label, extract) in [
+        ('generic cascade', lambda: generic.get_meta(page)),
+        ('site profile', lambda: profile.extract(page)),
+    ]:
+        seconds = min(timeit.repeat(extract, number=1, repeat=RUNS))
+        print('%-16s %7.2f ms' % (label, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
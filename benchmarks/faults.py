@@ -0,0 +1,210 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Fault-injection web server, and a benchmark previewing its pathological
+pages concurrently with the generic previewer.
+
+Every scenario is served on its own loopback address (127.0.0.2, …), so
+they don't queue behind each other in the per-host connection limit:
+
+    chunked   endless chunked body
+    drip      a body that trickles in one byte at a time
+    oneline   a huge page that is a single line of HTML
+    headers   a response with a huge header block
+    redirect  an endless chain of redirects
+    tls       accepts connections, but never completes the TLS handshake
+    normal    a well-behaved page, for comparison
+
+test.py runs the same scenarios with assertions. Run from the directory
+containing the plugin:
+    python3 -m URLpreview.benchmarks.faults
+"""
+
+import resource
+import socketserver
+import threading
+import time
+
+from URLpreview import resolver, stats
+from URLpreview.previewers import generic
+
+DRIP_INTERVAL = 0.05      # Seconds between the bytes of drip
+ONELINE_SIZE = 50 * 1024 * 1024
+HEADER_LINES = 10000
+CONCURRENCY = 4           # Previews per scenario at the same time
+
+PAGE = (b'<html><head><title>Normal page</title>'
+        b'<meta name="description" content="Nothing to see here">'
+        b'</head><body>Hello</body></html>')
+
+
+def send_headers(wfile, *headers):
+    wfile.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n')
+    for header in headers:
+        wfile.write(header + b'\r\n')
+    wfile.write(b'\r\n')
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            first = self.rfile.peek(1)[:1]
+            if first == b'\x16':
+                return self.hang()  # TLS ClientHello
+            path = self.rfile.readline().split(b' ')[1].decode()
+            while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                pass
+            getattr(self, self.server.scenario)(path)
+        except (ConnectionError, OSError):
+            pass  # The client gave up, as it should
+
+    def hang(self):
+        while self.request.recv(4096):
+            pass
+
+    def chunked(self, path):
+        send_headers(self.wfile, b'Transfer-Encoding: chunked')
+        chunk = b'<p>' + b'x' * 8189 + b'</p>'
+        while True:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+
+    def drip(self, path):
+        send_headers(self.wfile, b'Content-Length: 1000000')
+        self.wfile.write(b'<html><head>')
+        while True:
+            self.wfile.write(b' ')
+            self.wfile.flush()
+            time.sleep(DRIP_INTERVAL)
+
+    def oneline(self, path):
+        send_headers(self.wfile, b'Content-Length: %d' % ONELINE_SIZE)
+        head = b'<html><head><title>One line</title></head><body>'
+        self.wfile.write(head)
+        line = b'word ' * 20000
+        for _ in range((ONELINE_SIZE - len(head)) // len(line)):
+            self.wfile.write(line)
+
+    def headers(self, path):
+        send_headers(self.wfile, *[b'X-Filler-%d: %s' % (i, b'y' * 1000)
+                                   for i in range(HEADER_LINES)])
+        self.wfile.write(PAGE)
+
+    def redirect(self, path):
+        # Every page redirects to the next one
+        number = int(path.rpartition('/')[2] or 0)
+        self.wfile.write(b'HTTP/1.1 302 Found\r\nLocation: /%d\r\n'
+                         b'Content-Length: 0\r\n\r\n' % (number + 1))
+
+    def normal(self, path):
+        send_headers(self.wfile, b'Content-Length: %d' % len(PAGE))
+        self.wfile.write(PAGE)
+
+
+SCENARIOS = ['chunked', 'drip', 'oneline', 'headers', 'redirect', 'tls',
+             'normal']
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, scenario, address):
+        super().__init__((address, 0), Handler)
+        self.scenario = scenario
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        scheme = 'https' if self.scenario == 'tls' else 'http'
+        return '%s://%s:%d/' % (scheme, *self.server_address)
+
+
+def start_servers():
+    """Starts a server for each scenario, returns {scenario: url}"""
+    servers = [Server(scenario, '127.0.0.%d' % (i + 2))
+               for (i, scenario) in enumerate(SCENARIOS)]
+    return servers, {server.scenario: server.url for server in servers}
+
+
+def preview(url):
+    """Previews <url>, returns (preview, seconds)"""
+    start = time.perf_counter()
+    result = generic.handle(url)
+    return result, time.perf_counter() - start
+
+
+def preview_all(urls, concurrency=CONCURRENCY, timeout=None):
+    """Previews every URL <concurrency> times at once, with empty caches.
+    Returns {url: [seconds, …]}, previews still running after <timeout>
+    seconds are left behind and count as taking forever."""
+    generic.preview_cache.clear()
+    generic.redirect_cache.clear()
+    jobs = [url for url in urls for _ in range(concurrency)]
+    results = [None] * len(jobs)
+
+    def run(i):
+        results[i] = preview(jobs[i])
+
+    # Daemon threads, so a preview that hangs can't keep us from exiting
+    threads = [threading.Thread(target=run, args=(i,), daemon=True)
+               for i in range(len(jobs))]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    for thread in threads:
+        thread.join(None if deadline is None
+                    else max(0, deadline - time.monotonic()))
+    times = {}
+    for (url, result) in zip(jobs, results):
+        seconds = result[1] if result is not None else float('inf')
+        times.setdefault(url, []).append(seconds)
+    return times
+
+
+def main():
+    resolver.BLOCK_INTERNAL = False
+    servers, urls = start_servers()
+    threads = threading.active_count()
+    start = time.perf_counter()
+    times = preview_all(urls.values())
+    total = time.perf_counter() - start
+    for (scenario, url) in urls.items():
+        print('%-9s max %6.2fs' % (scenario, max(times[url])))
+    print('all %d previews: %.2fs, threads left over: %d, peak RSS: '
+          '%.1f MiB' % (len(urls) * CONCURRENCY, total,
+                        threading.active_count() - threads,
+                        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                        / 1024))
+    print(stats.summary())
+    for server in servers:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
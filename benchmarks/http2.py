@@ -0,0 +1,127 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Compares API lookups over HTTP/1.1 and HTTP/2 (api.get()) at different
+concurrency levels, against a local stand-in API server.
+
+Needs httpx[http2] and hypercorn. Run from the directory containing the
+plugin:
+    python3 -m URLpreview.benchmarks.http2
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import socket
+import threading
+import time
+
+import httpx
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+
+from URLpreview import api
+
+DELAY = 0.02          # Simulated processing time of the API, in seconds
+LOOKUPS = 200         # Lookups per measurement
+CONCURRENCY = [1, 10, 100]
+
+connections = set()
+
+
+async def app(scope, receive, send):
+    if scope['type'] != 'http':
+        return
+    connections.add(tuple(scope['client']))
+    await asyncio.sleep(DELAY)
+    body = b'{"pageInfo": {"totalResults": 1}}'
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def start_server():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    config = Config()
+    config.bind = ['127.0.0.1:%d' % port]
+    config.loglevel = 'WARNING'
+    config.keep_alive_timeout = 60
+    # A shutdown trigger keeps hypercorn from installing signal handlers,
+    # which only works in the main thread
+    thread = threading.Thread(
+        target=lambda: asyncio.run(
+            serve(app, config, shutdown_trigger=asyncio.Event().wait)),
+        daemon=True)
+    thread.start()
+    time.sleep(1)
+    return 'http://127.0.0.1:%d/youtube/v3/videos' % port
+
+
+def measure(url, concurrency):
+    def lookup(_):
+        start = time.perf_counter()
+        r = api.get(url)
+        assert r.status_code == 200
+        return time.perf_counter() - start
+
+    connections.clear()
+    with ThreadPoolExecutor(concurrency) as pool:
+        start = time.perf_counter()
+        latencies = sorted(pool.map(lookup, range(LOOKUPS)))
+        total = time.perf_counter() - start
+    return (latencies[len(latencies) // 2],
+            latencies[len(latencies) * 95 // 100],
+            LOOKUPS / total, len(connections))
+
+
+def main():
+    url = start_server()
+    print('%-9s %5s %10s %10s %10s %6s' %
+          ('protocol', 'conc.', 'median', 'p95', 'lookups/s', 'conns'))
+    for protocol in ['HTTP/1.1', 'HTTP/2']:
+        api.close()
+        if protocol == 'HTTP/2':
+            api.HTTP2 = True
+            # No TLS here, so the client has to know the server speaks h2
+            api._client = httpx.Client(http1=False, http2=True)
+        else:
+            api.HTTP2 = False
+        for concurrency in CONCURRENCY:
+            measure(url, concurrency)  # Warm up
+            median, p95, rate, conns = measure(url, concurrency)
+            print('%-9s %5d %8.1fms %8.1fms %10.0f %6d' %
+                  (protocol, concurrency, median * 1000, p95 * 1000, rate,
+                   conns))
+
+
+if __name__ == '__main__':
+    main()
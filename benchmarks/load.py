@@ -0,0 +1,234 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Drives chat traffic through URLpreview.doPrivmsg and measures how the
+plugin copes with it.
+
+The messages come from a bot log with debug logging enabled (the
+"Incoming message" lines of logs/messages.log), or are generated. Links
+are rewritten to point to a local stand-in web server, so every link is
+previewed by the generic previewer. Messages are handled one after the
+other, as the bot's driver does, at the pace of the log (--speed 1),
+faster (--speed 10) or as fast as possible (--speed 0).
+
+Run from the directory containing the plugin:
+    python3 -m URLpreview.benchmarks.load --log logs/messages.log
+    python3 -m URLpreview.benchmarks.load --messages 2000 --channels 20
+"""
+
+import argparse
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import random
+import resource
+import threading
+import time
+
+import regex as re
+
+from supybot import conf, ircmsgs
+
+import URLpreview
+from URLpreview import resolver, stats
+
+SERVER_DELAY = 0.05       # Simulated response time of the web server
+SAMPLE_INTERVAL = 0.01    # How often to count threads, in seconds
+
+LOG_PATTERN = re.compile(
+    r'^\w+ (\S+) Incoming message \([^)]*\): (.*)$')
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'  # supybot.log.timestampFormat
+URL_PATTERN = re.compile(r'https?://([^/\s]+)(\S*)')
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(SERVER_DELAY)
+        body = ('<html><head><title>Page %s</title>'
+                '<meta name="description" content="Stand-in for %s">'
+                '</head><body>%s</body></html>' %
+                (self.path, self.path, 'Lorem ipsum. ' * 200)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Irc:
+    """The parts of an Irc object the plugin uses"""
+    network = 'load'
+    nick = 'URLpreview'
+
+    def __init__(self):
+        self.sent = 0
+
+    def queueMsg(self, msg):
+        self.sent += 1
+
+    def isChannel(self, channel):
+        return channel.startswith('#')
+
+
+def read_log(path):
+    """Returns [(seconds, IrcMsg)] for the channel messages in the log"""
+    messages = []
+    start = None
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            match = LOG_PATTERN.match(line.strip())
+            if match is None:
+                continue
+            try:
+                msg = ircmsgs.IrcMsg(match.group(2))
+                when = datetime.strptime(match.group(1), TIMESTAMP_FORMAT)
+            except Exception:
+                continue
+            if msg.command != 'PRIVMSG' or not msg.args[0].startswith('#'):
+                continue
+            start = start or when
+            messages.append(((when - start).total_seconds(), msg))
+    return messages
+
+
+def generate(count, channels, rate, url_density, cross_posting):
+    """Returns [(seconds, IrcMsg)] with <count> messages, <rate> per second,
+    in <channels> channels. <url_density> of them contain a link,
+    <cross_posting> of those a link posted to another channel before."""
+    rng = random.Random(0)
+    posted = []
+    messages = []
+    for i in range(count):
+        channel = '#load%d' % rng.randrange(channels)
+        text = 'message %d' % i
+        if rng.random() < url_density:
+            if posted and rng.random() < cross_posting:
+                url = rng.choice(posted)
+            else:
+                url = 'https://site%d.example.org/article/%d' % \
+                    (rng.randrange(50), i)
+                posted.append(url)
+            text += ' look at %s' % url
+        msg = ircmsgs.privmsg(channel, text,
+                              prefix='user%d!u@h' % rng.randrange(100))
+        messages.append((i / rate, msg))
+    return messages
+
+
+def rewrite(msg, base):
+    """Returns <msg> with its links pointing to the stand-in server"""
+    text = URL_PATTERN.sub(lambda m: '%s/%s%s' % (base, m.group(1),
+                                                  m.group(2)), msg.args[1])
+    return ircmsgs.privmsg(msg.args[0], text, prefix=msg.prefix)
+
+
+def run(messages, speed):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:%d' % server.server_address[1]
+    resolver.BLOCK_INTERNAL = False
+
+    irc = Irc()
+    plugin = URLpreview.Class(irc)
+    latencies = []
+    peak_threads = threading.active_count()
+    done = threading.Event()
+
+    def sample():
+        nonlocal peak_threads
+        while not done.wait(SAMPLE_INTERVAL):
+            peak_threads = max(peak_threads, threading.active_count())
+
+    threading.Thread(target=sample, daemon=True).start()
+    start = time.perf_counter()
+    for (when, msg) in messages:
+        if speed:
+            delay = start + when / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        msg = rewrite(msg, base)
+        before = time.perf_counter()
+        plugin.doPrivmsg(irc, msg)
+        if base in msg.args[1]:
+            latencies.append(time.perf_counter() - before)
+    total = time.perf_counter() - start
+    done.set()
+    plugin.die()
+    server.shutdown()
+    return total, latencies, irc.sent, peak_threads
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, len(values) * p // 100)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log', help='bot log to replay')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='1: pace of the log, 0: as fast as possible')
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--channels', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=20,
+                        help='messages per second')
+    parser.add_argument('--url-density', type=float, default=0.2)
+    parser.add_argument('--cross-posting', type=float, default=0.1)
+    args = parser.parse_args()
+    if args.log:
+        messages = read_log(args.log)
+    else:
+        messages = generate(args.messages, args.channels, args.rate,
+                            args.url_density, args.cross_posting)
+    if not messages:
+        parser.error('no channel messages found (is debug logging on?)')
+
+    # Measure the plugin, not the per-channel limits
+    with conf.supybot.plugins.URLpreview.rate_limit.context(0):
+        total, latencies, sent, threads = run(messages, args.speed)
+
+    latencies.sort()
+    print('%d messages in %.2fs: %.0f messages/s, %d with links, '
+          '%d previews sent' % (len(messages), total, len(messages) / total,
+                                len(latencies), sent))
+    if latencies:
+        print('latency of messages with links: p50 %.1fms, p90 %.1fms, '
+              'p99 %.1fms, max %.1fms' %
+              tuple(x * 1000 for x in (percentile(latencies, 50),
+                                       percentile(latencies, 90),
+                                       percentile(latencies, 99),
+                                       latencies[-1])))
+    print('peak threads: %d, peak RSS: %.1f MiB' %
+          (threads, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    print(stats.summary())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Times generic previews replayed from a cassette (see transport.py), so
+runs on different machines or versions of the plugin can be compared
+without depending on the network.
+
+Record the links in a file (one per line) once:
+    python3 -m URLpreview.benchmarks.replay --record links.cassette links.txt
+and replay them, at full speed or with the recorded latencies:
+    python3 -m URLpreview.benchmarks.replay links.cassette links.txt
+    python3 -m URLpreview.benchmarks.replay --realtime links.cassette links.txt
+"""
+
+import argparse
+import time
+
+from URLpreview import oembed, transport
+from URLpreview.previewers import generic
+
+ROUNDS = 5            # Replays of the whole list
+
+
+def preview_all(urls):
+    """Previews <urls> with empty caches, returns the latencies"""
+    generic.preview_cache.clear()
+    generic.redirect_cache.clear()
+    oembed.endpoints.clear()
+    latencies = []
+    for url in urls:
+        start = time.perf_counter()
+        generic.handle(url)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--record', action='store_true')
+    parser.add_argument('--realtime', action='store_true')
+    parser.add_argument('cassette')
+    parser.add_argument('links')
+    args = parser.parse_args()
+    with open(args.links) as f:
+        urls = [line.strip() for line in f if line.strip()]
+
+    if args.record:
+        with transport.cassette(args.cassette, transport.RECORD):
+            preview_all(urls)
+        print('Recorded %d links into %s' % (len(urls), args.cassette))
+        return
+
+    with transport.cassette(args.cassette, realtime=args.realtime):
+        rounds = 1 if args.realtime else ROUNDS
+        latencies = sorted(latency for _ in range(rounds)
+                           for latency in preview_all(urls))
+    print('%d previews: median %.1fms, p95 %.1fms, total %.2fs' %
+          (len(latencies), latencies[len(latencies) // 2] * 1000,
+           latencies[len(latencies) * 95 // 100] * 1000, sum(latencies)))
+
+
+if __name__ == '__main__':
+    main()
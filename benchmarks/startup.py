@@ -0,0 +1,95 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Measures how long it takes to load and reload the plugin.
+
+Every measurement runs in a fresh interpreter, so imports are cold.
+Run from the directory containing the plugin:
+    python3 -m URLpreview.benchmarks.startup
+"""
+
+import subprocess
+import sys
+
+TARGET_COLD_LOAD = 0.05   # seconds for loading the plugin, without supybot
+RUNS = 5
+
+# Supybot itself is imported before the clock starts, as the bot has
+# loaded it long before any plugin.
+SCRIPT = '''
+import importlib, sys, time
+import supybot.callbacks, supybot.conf, supybot.registry
+start = time.perf_counter()
+import URLpreview
+from URLpreview.previewer import PreviewerCollection
+collection = PreviewerCollection()
+loaded = time.perf_counter()
+collection.get_previewer('example.org')
+collection.get_generic()
+first_use = time.perf_counter()
+importlib.reload(URLpreview)
+collection = PreviewerCollection()
+collection.get_previewer('example.org')
+collection.get_generic()
+reloaded = time.perf_counter()
+heavy = [m for m in ('bs4', 'dateutil', 'humanize', 'requests')
+         if m in sys.modules]
+print('RESULT', loaded - start, first_use - loaded, reloaded - first_use,
+      ','.join(heavy))
+'''
+
+
+def measure():
+    output = subprocess.run(
+        [sys.executable, '-c', SCRIPT], check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        universal_newlines=True).stdout
+    # Supybot logs to stdout as well
+    line = [line for line in output.splitlines()
+            if line.startswith('RESULT')][0]
+    fields = line.split(' ')
+    return [float(x) for x in fields[1:4]] + [fields[4]]
+
+
+def main():
+    results = [measure() for _ in range(RUNS)]
+    for (i, label) in enumerate(['cold load', 'first use', 'reload']):
+        times = sorted(r[i] for r in results)
+        print('%-10s median %6.1f ms  min %6.1f ms' %
+              (label, times[len(times) // 2] * 1000, times[0] * 1000))
+    print('heavy modules imported after first use: %s' %
+          (results[0][3] or 'none'))
+    median = sorted(r[0] for r in results)[len(results) // 2]
+    print('target for cold load: %.0f ms – %s' %
+          (TARGET_COLD_LOAD * 1000,
+           'met' if median <= TARGET_COLD_LOAD else 'MISSED'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Pool of preallocated download buffers
+
+Downloads are read straight into a pooled bytearray and handed on as a
+memoryview, so a page is held in memory exactly once, and the buffers are
+reused instead of being allocated for every preview.
+"""
+
+from contextlib import contextmanager
+import threading
+
+from URLpreview import stats
+
+
+class BufferPool:
+    def __init__(self, size, max_idle=4):
+        self.size = size          # Size of each buffer in bytes
+        self.max_idle = max_idle  # Number of unused buffers to keep around
+        self.in_use = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            buffer = self._idle.pop() if self._idle else None
+            self.in_use += 1
+            in_use = self.in_use
+        if buffer is None:
+            buffer = bytearray(self.size)
+            stats.incr('buffers_allocated')
+        stats.peak('buffers_peak_bytes', in_use * self.size)
+        return buffer
+
+    def release(self, buffer):
+        with self._lock:
+            self.in_use -= 1
+            if len(self._idle) < self.max_idle:
+                self._idle.append(buffer)
+
+    @contextmanager
+    def borrow(self):
+        """Context manager that acquires and releases a buffer. Don't keep
+        references (e.g. memoryviews) to the buffer after leaving it."""
+        buffer = self.acquire()
+        try:
+            yield buffer
+        finally:
+            self.release(buffer)
@@ -0,0 +1,214 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""In-memory caches for previews"""
+
+from collections import OrderedDict
+import threading
+import time
+
+from supybot import log
+
+from URLpreview import stats
+
+
+class Entry:
+    __slots__ = ('value', 'etag', 'last_modified', 'expires', 'hits',
+                 'refreshing', 'counters_expire')
+
+    def __init__(self, value, etag=None, last_modified=None, expires=0):
+        self.value = value
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires = expires
+        self.hits = 0
+        self.refreshing = False
+        self.counters_expire = expires  # Used by EntityCache
+
+    def is_fresh(self, now=None):
+        return (now or time.monotonic()) < self.expires
+
+    def validators(self):
+        """Returns the headers to revalidate this entry with"""
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class PreviewCache:
+    """Thread-safe LRU cache. Entries are kept for <max_stale> seconds past
+    their expiry so they can still be revalidated or served stale."""
+
+    def __init__(self, max_entries=1024, ttl=600, max_stale=86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the entry for <key>, fresh or not, or None"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if now > entry.expires + self.max_stale:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            entry.hits += 1
+            return entry
+
+    def put(self, key, value, etag=None, last_modified=None, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        entry = Entry(value, etag, last_modified, time.monotonic() + ttl)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                entry.hits = old.hits
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def refresh(self, key, ttl=None):
+        """Marks the entry for <key> as fresh again, e.g. after a 304"""
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.expires = time.monotonic() + ttl
+                entry.refreshing = False
+            return entry
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def claim_refresh(self, entry):
+        """Returns True if the caller should refresh <entry> in the
+        background, False if somebody else is already doing it"""
+        with self._lock:
+            if entry.refreshing:
+                return False
+            entry.refreshing = True
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class EntityCache(PreviewCache):
+    """Cache for previews of API entities (videos, tweets, users) by their
+    id. The counters of a preview (views, followers, …) go stale sooner
+    than the rest of it; they are refreshed on their own, and in batches:
+    whenever an entity's counters are refreshed, up to <batch_size> - 1
+    other entities whose counters are stale come along."""
+
+    def __init__(self, name, max_entries=512, ttl=86400, counters_ttl=None,
+                 batch_size=50):
+        super().__init__(max_entries, ttl, max_stale=0)
+        self.name = name                  # Prefix for stats
+        self.counters_ttl = counters_ttl  # None: counters don't go stale
+        self.batch_size = batch_size
+
+    def get_preview(self, key, fetch, fetch_counters=None, get_ttl=None):
+        """Returns the preview for <key>, from the cache if possible.
+        fetch(key) returns a new preview or None, get_ttl(preview) how long
+        to keep it (by default self.ttl). fetch_counters(keys) returns
+        {key: counters} for the keys it could get. If it fails, the old
+        counters are kept until the next refresh is due."""
+        entry = self.get(key)
+        now = time.monotonic()
+        if entry is None or not entry.is_fresh(now):
+            stats.incr('%s_cache_misses' % self.name)
+            preview = fetch(key)
+            if preview is not None:
+                self._store(key, preview,
+                            get_ttl(preview) if get_ttl else self.ttl)
+            return preview
+        if now < entry.counters_expire or fetch_counters is None:
+            stats.incr('%s_cache_hits' % self.name)
+            return entry.value
+        keys = [key] + self.stale_counters(now, key)
+        try:
+            counters = fetch_counters(keys)
+        except Exception as e:
+            log.info('URLpreview: refreshing %s counters failed: %r' %
+                     (self.name, e))
+            stats.incr('%s_counter_failures' % self.name)
+            counters = {}
+        stats.incr('%s_counter_refreshes' % self.name)
+        stats.incr('%s_counters_refreshed' % self.name, len(counters))
+        self.update_counters(counters, keys)
+        return entry.value
+
+    def _store(self, key, preview, ttl):
+        entry = self.put(key, preview, ttl=ttl)
+        if self.counters_ttl is not None:
+            entry.counters_expire = min(entry.expires,
+                                        time.monotonic() + self.counters_ttl)
+
+    def stale_counters(self, now, exclude):
+        """Returns the keys of up to batch_size - 1 fresh entries (apart
+        from <exclude>) whose counters are stale, most recently used first"""
+        keys = []
+        with self._lock:
+            for (key, entry) in reversed(self._entries.items()):
+                if len(keys) >= self.batch_size - 1:
+                    break
+                if key != exclude and entry.is_fresh(now) and \
+                        now >= entry.counters_expire:
+                    keys.append(key)
+        return keys
+
+    def update_counters(self, counters, keys=()):
+        """Replaces the counters of the cached previews with <counters>,
+        {key: counters}. The counters of the other <keys> were asked for
+        but not returned; they aren't asked for again until the next
+        refresh is due, so an API that fails isn't called for every paste"""
+        counters_expire = time.monotonic() + self.counters_ttl
+        with self._lock:
+            for key in set(keys).union(counters):
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if key in counters:
+                    entry.value = entry.value.replace(counters=counters[key])
+                entry.counters_expire = min(entry.expires, counters_expire)
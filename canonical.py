@@ -0,0 +1,131 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Rewrites URLs into a canonical form, so that different ways of writing
+the same link share cache entries and are recognized as duplicates.
+
+Everything here is table-driven: add host aliases, rewrite rules or
+tracking parameters below.
+"""
+
+from urllib.parse import urlsplit, urlunsplit
+
+import regex as re
+
+# Hosts that serve the same content as another host
+HOST_ALIASES = {
+    # youtube
+    'youtube.com': 'www.youtube.com',
+    'm.youtube.com': 'www.youtube.com',
+    'www.youtu.be': 'youtu.be',
+    # twitter
+    'www.twitter.com': 'twitter.com',
+    'mobile.twitter.com': 'twitter.com',
+    'm.twitter.com': 'twitter.com',
+}
+
+# Per-previewer rules: host -> [(pattern, replacement), …]
+# The pattern is matched against path?query of the URL, the first match wins
+# and its expansion is the canonical URL.
+REWRITE_RULES = {
+    # youtube
+    'youtu.be': [
+        (r'^/([\w-]+)', r'https://www.youtube.com/watch?v=\1'),
+    ],
+    'www.youtube.com': [
+        (r'^/watch\?(?:.*&)?v=([\w-]+)',
+         r'https://www.youtube.com/watch?v=\1'),
+        (r'^/(?:embed|live|shorts|v)/([\w-]+)',
+         r'https://www.youtube.com/watch?v=\1'),
+    ],
+    # twitter
+    'twitter.com': [
+        (r'^/(\w+)/status(?:es)?/(\d+)/?(?:\?.*)?$',
+         r'https://twitter.com/\1/status/\2'),
+    ],
+}
+
+# Query parameters that only serve to track who clicked on what
+TRACKING_PARAMS = frozenset([
+    '_ga', '_hsenc', '_hsmi', 'dclid', 'fbclid', 'gclid', 'gclsrc',
+    'igshid', 'mc_cid', 'mc_eid', 'mkt_tok', 'msclkid', 'oly_anon_id',
+    'oly_enc_id', 'ref_src', 'ref_url', 'rb_clickid', 'twclid', 'vero_id',
+    'wickedid', 'yclid',
+])
+TRACKING_PREFIXES = ('utm_', 'pk_', 'mtm_')
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+_rules = {host: [(re.compile(pattern), replacement)
+                 for (pattern, replacement) in rules]
+          for (host, rules) in REWRITE_RULES.items()}
+
+
+def canonicalize(url):
+    """Returns the canonical form of <url>"""
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url  # Leave anything unparsable alone
+    scheme = parts.scheme.lower()
+    host = parts.hostname or ''
+    host = HOST_ALIASES.get(host, host)
+
+    rules = _rules.get(host)
+    if rules is not None:
+        path = parts.path
+        if parts.query:
+            path += '?' + parts.query
+        for (pattern, replacement) in rules:
+            match = pattern.match(path)
+            if match is not None:
+                return match.expand(replacement)
+
+    netloc = host if ':' not in host else '[%s]' % host
+    if parts.username is not None or parts.password is not None:
+        netloc = parts.netloc.rpartition('@')[0] + '@' + netloc
+    if port is not None and DEFAULT_PORTS.get(scheme) != port:
+        netloc += ':%d' % port
+    query = parts.query
+    if query:
+        query = strip_tracking(query)
+    # The fragment is never sent to the server, so drop it
+    return urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+
+def strip_tracking(query):
+    """Removes tracking parameters from the query string <query>"""
+    kept = []
+    for param in query.split('&'):
+        name = param.partition('=')[0].lower()
+        if name in TRACKING_PARAMS or name.startswith(TRACKING_PREFIXES):
+            continue
+        kept.append(param)
+    return '&'.join(kept)
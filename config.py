@@ -53,11 +53,75 @@ def configure(advanced):
     previewers.configure(URLpreview, advanced)
 
 
+class ProxySelection(registry.OnlySomeStrings):
+    """Valid values are 'round-robin' and 'least-latency'"""
+    validStrings = ('round-robin', 'least-latency')
+
+
 URLpreview = conf.registerPlugin('URLpreview')
 # General
 conf.registerChannelValue(
     URLpreview, 'enabled',
     registry.Boolean(True, _('enable for this channel')))
+conf.registerChannelValue(
+    URLpreview, 'repeat_window',
+    registry.NonNegativeInteger(300, _("""don't preview a URL again if it
+    was previewed in the channel less than this many seconds ago
+    (0 to disable)""")))
+conf.registerChannelValue(
+    URLpreview, 'rate_limit',
+    registry.NonNegativeInteger(10, _("""maximum number of previews per
+    minute in the channel (0 for no limit)""")))
+conf.registerChannelValue(
+    URLpreview, 'prefetch',
+    registry.Boolean(False, _("""preview links in the channel topic in the
+    background, so they are cached when somebody pastes them""")))
+conf.registerChannelValue(
+    URLpreview, 'colors',
+    registry.Boolean(True, _('use bold text and colors in previews')))
+conf.registerChannelValue(
+    URLpreview, 'title_length',
+    registry.PositiveInteger(140, _('length after which titles are cut')))
+conf.registerChannelValue(
+    URLpreview, 'description_length',
+    registry.PositiveInteger(280,
+                             _('length after which descriptions are cut')))
+
+# Proxies
+conf.registerGlobalValue(
+    URLpreview, 'proxies',
+    registry.SpaceSeparatedListOfStrings([], _("""egress proxies to fetch
+    through, like http://host:3128 or socks5h://host:1080 (SOCKS needs
+    PySocks). Leave empty to connect directly.""")))
+conf.registerGlobalValue(
+    URLpreview, 'proxy_selection',
+    ProxySelection('round-robin', _("""how to pick a proxy:
+    round-robin or least-latency""")))
+conf.registerGlobalValue(
+    URLpreview, 'proxy_max_latency',
+    registry.PositiveFloat(5.0, _("""proxies slower than this many seconds
+    are taken out of rotation until they are faster again""")))
+conf.registerGlobalValue(
+    URLpreview, 'proxy_check_url',
+    registry.String('https://www.google.com/generate_204', _("""URL
+    requested through each proxy to check its health""")))
+
+# Daemon
+conf.registerGlobalValue(
+    URLpreview, 'daemon_socket',
+    registry.String('', _("""path of the Unix domain socket of a preview
+    daemon shared with other bots (see daemon.py); previews are made
+    in-process if empty or if the daemon can't be reached""")))
+
+# Profiling
+conf.registerGlobalValue(
+    URLpreview, 'profile_threshold',
+    registry.Float(5.0, _("""keep a profile of previews that take at least
+    this many seconds, see the slowpreviews command (0 to disable)""")))
+conf.registerGlobalValue(
+    URLpreview, 'profile_memory',
+    registry.Boolean(False, _("""also trace memory allocations for the
+    profiles (makes all previews slower)""")))
 
 # Generic
 conf.registerGlobalValue(
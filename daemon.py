@@ -0,0 +1,297 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Shared preview daemon
+
+Several bots on one host can hand their previews to one daemon process over
+a Unix domain socket, so fetching, caching and parsing happen once for all of
+them. Start it from the directory containing the plugin:
+    python3 -m URLpreview.daemon /run/urlpreview.sock --config bot.conf
+and set supybot.plugins.URLpreview.daemon_socket to the socket's path.
+
+The protocol is one line of JSON per request and response:
+    {"url": "https://…", "options": {"title_length": 140, …}}
+    {"text": "Preview: …"}     (null if there's no preview)
+Bots keep their connection open and make their previews themselves while the
+daemon can't be reached.
+"""
+
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+from supybot import conf, log
+
+from URLpreview import stats
+from URLpreview.preview import DEFAULT_OPTIONS, format_preview
+from URLpreview.previewer import PreviewerCollection
+
+TIMEOUT = 30              # Seconds to wait for a preview from the daemon
+RETRY_INTERVAL = 30       # Seconds before trying an unreachable daemon again
+MAX_REQUEST = 8192        # Max. length of a request line, in bytes
+SOCKET_MODE = 0o660       # Only the daemon's user and group may connect
+
+
+class Unavailable(ConnectionError):
+    """The daemon couldn't be reached or didn't answer"""
+
+
+class Client:
+    """Makes previews through the daemon, with one connection per thread"""
+
+    def __init__(self, timeout=TIMEOUT):
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = set()
+        self._lock = threading.Lock()
+        self._down_until = 0
+
+    def get_preview(self, path, url, options):
+        """Returns the daemon's preview text for <url>, or None. Raises
+        Unavailable if the daemon can't be used right now."""
+        if time.monotonic() < self._down_until:
+            raise Unavailable('%s is down' % path)
+        request = json.dumps({'url': url, 'options': options}) + '\n'
+        try:
+            response = self._request(path, request.encode())
+        except (OSError, ValueError) as e:
+            self._down_until = time.monotonic() + RETRY_INTERVAL
+            log.warning('URLpreview: daemon at %s is unavailable, making '
+                        'previews in-process for %ds: %r' %
+                        (path, RETRY_INTERVAL, e))
+            raise Unavailable(repr(e)) from e
+        stats.incr('daemon_previews')
+        return response.get('text')
+
+    def _request(self, path, request):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and connection[0] != path:
+            self._close(connection)
+            connection = None
+        # A kept connection may have been closed by a restarted daemon, so
+        # it gets a second chance with a new one
+        for attempt in ('kept', 'new'):
+            if connection is None:
+                if attempt == 'kept':
+                    continue
+                connection = self._connect(path)
+            try:
+                connection[1].sendall(request)
+                line = connection[2].readline()
+                if not line.endswith(b'\n'):
+                    raise ConnectionError('connection closed by daemon')
+                response = json.loads(line)
+                if not isinstance(response, dict):
+                    raise ValueError('unexpected response %r' % line)
+                return response
+            except (OSError, ValueError):
+                self._close(connection)
+                connection = None
+                if attempt == 'new':
+                    raise
+
+    def _connect(self, path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            raise
+        connection = (path, sock, sock.makefile('rb'))
+        self._local.connection = connection
+        with self._lock:
+            self._connections.add(connection)
+        return connection
+
+    def _close(self, connection):
+        self._local.connection = None
+        with self._lock:
+            self._connections.discard(connection)
+        connection[2].close()
+        connection[1].close()
+
+    def close(self):
+        """Closes the connections of all threads"""
+        with self._lock:
+            connections = list(self._connections)
+            self._connections.clear()
+        for (_, sock, rfile) in connections:
+            rfile.close()
+            sock.close()
+
+
+class Flight:
+    """A preview being made, which requests for the same URL wait for"""
+    __slots__ = ('done', 'preview')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.preview = None
+
+
+class Daemon:
+    """Stands in for the plugin towards the previewers"""
+
+    def __init__(self):
+        self.previewers = PreviewerCollection()
+        self._flights = {}  # URL -> Flight
+        self._lock = threading.Lock()
+
+    def registryValue(self, name, channel=None, network=None):
+        return conf.supybot.plugins.URLpreview.get(name)()
+
+    def get_preview(self, url):
+        """Returns the preview of <url>. Concurrent requests for the same
+        URL (the same link pasted on several networks) share one preview."""
+        with self._lock:
+            flight = self._flights.get(url)
+            leader = flight is None
+            if leader:
+                flight = self._flights[url] = Flight()
+        if not leader:
+            stats.incr('daemon_coalesced')
+            flight.done.wait()
+            return flight.preview
+        try:
+            flight.preview = self._make_preview(url)
+        finally:
+            with self._lock:
+                del self._flights[url]
+            flight.done.set()
+        return flight.preview
+
+    def _make_preview(self, url):
+        domain = urlsplit(url).hostname or ''
+        previewer = self.previewers.get_previewer(domain)
+        if previewer is not None:
+            return previewer.get_preview(self, url)
+        if self.registryValue('generic_enabled'):
+            generic = self.previewers.get_generic()
+            if generic.can_handle(domain):
+                return generic.handle(url)
+        return None
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.server.connections.add(self.request)
+
+    def finish(self):
+        self.server.connections.discard(self.request)
+        try:
+            super().finish()
+        except OSError:
+            pass  # Closed by server_close()
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_REQUEST)
+            if not line.endswith(b'\n'):
+                return  # Closed, or the request is too long
+            try:
+                request = json.loads(line)
+                url = request['url']
+                options = dict(DEFAULT_OPTIONS)
+                options.update(request.get('options') or {})
+            except (ValueError, KeyError, TypeError) as e:
+                log.info('URLpreview.daemon: bad request %r: %r' % (line, e))
+                return
+            try:
+                text = format_preview(self.server.daemon.get_preview(url),
+                                      options)
+            except Exception as e:
+                log.info('URLpreview.daemon: "%s", exception %s' %
+                         (url, repr(e)))
+                text = None
+            self.wfile.write(json.dumps({'text': text}).encode() + b'\n')
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        # Remove the socket of a daemon that's gone
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except ConnectionRefusedError:
+                os.unlink(path)
+            finally:
+                probe.close()
+        super().__init__(path, Handler)
+        os.chmod(path, SOCKET_MODE)
+        self.daemon = Daemon()
+        self.connections = set()  # Sockets of the connected bots
+
+    def server_close(self):
+        super().server_close()
+        # Bots notice this on their next request, and fall back to making
+        # previews in-process
+        for sock in list(self.connections):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        os.unlink(self.server_address)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Makes previews for the bots connected to SOCKET')
+    parser.add_argument('socket', help='path of the Unix domain socket')
+    parser.add_argument('--config', help="""a bot's configuration file to
+                        read the URLpreview settings (e.g. API keys) from""")
+    args = parser.parse_args()
+    if args.config:
+        from supybot import registry
+        registry.open_registry(args.config)
+    server = Server(args.socket)
+    # Exit cleanly (removing the socket) when stopped, e.g. by systemd
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    log.info('URLpreview.daemon: listening on %s' % args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
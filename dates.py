@@ -0,0 +1,125 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Fast date parsing for the formats we see most.
+
+ISO 8601/RFC 3339 (meta tags, JSON-LD, APIs) and RFC 2822/HTTP dates are
+parsed with a compiled regex; anything else is handed to dateutil.
+Recent strings are memoized, as the same dates show up again and again.
+"""
+
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+import regex as re
+
+CACHE_SIZE = 2048
+
+ISO_PATTERN = re.compile(
+    r'\s*(\d{4})-(\d\d)-(\d\d)'
+    r'(?:[Tt ](\d\d):(\d\d)(?::(\d\d)(?:[.,](\d+))?)?'
+    r'\s*([Zz]|[+-]\d\d(?::?\d\d)?)?)?\s*$')
+
+RFC2822_PATTERN = re.compile(
+    r'\s*(?:[A-Za-z]{3},?\s+)?(\d{1,2})[\s-]+([A-Za-z]{3})[\s-]+(\d{4})'
+    r'\s+(\d\d):(\d\d)(?::(\d\d))?'
+    r'\s*(GMT|UTC?|Z|[+-]\d{4})?\s*$')
+
+MONTHS = {name: number for (number, name) in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+     'jul', 'aug', 'sep', 'oct', 'nov', 'dec'], 1)}
+
+
+def parse(string):
+    """Returns <string> as datetime, raises ValueError if it isn't a date"""
+    date = _parse(string)
+    if date is None:
+        raise ValueError('Unknown date format: %r' % string)
+    return date
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _parse(string):
+    try:
+        date = parse_iso(string) or parse_rfc2822(string)
+        if date is not None:
+            return date
+    except ValueError:
+        pass  # Looked right, but isn't a valid date. Let dateutil try.
+    return parse_other(string)
+
+
+def parse_iso(string):
+    match = ISO_PATTERN.match(string)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    microsecond = 0
+    if fraction is not None:
+        microsecond = int(fraction[:6].ljust(6, '0'))
+    return datetime(int(year), int(month), int(day),
+                    int(hour or 0), int(minute or 0), int(second or 0),
+                    microsecond, tzinfo=make_timezone(zone))
+
+
+def parse_rfc2822(string):
+    match = RFC2822_PATTERN.match(string)
+    if match is None:
+        return None
+    day, month, year, hour, minute, second, zone = match.groups()
+    month = MONTHS.get(month.lower())
+    if month is None:
+        return None
+    return datetime(int(year), month, int(day),
+                    int(hour), int(minute), int(second or 0),
+                    tzinfo=make_timezone(zone))
+
+
+def parse_other(string):
+    """Slow path: dateutil, imported on first use"""
+    from dateutil.parser import parse as dateutil_parse
+    try:
+        return dateutil_parse(string)
+    except (ValueError, OverflowError):
+        return None
+
+
+def make_timezone(zone):
+    if zone is None:
+        return None
+    if zone.upper() in ('Z', 'GMT', 'UT', 'UTC'):
+        return timezone.utc
+    sign = -1 if zone[0] == '-' else 1
+    digits = zone[1:].replace(':', '')
+    hours = int(digits[:2])
+    minutes = int(digits[2:4] or 0)
+    offset = timedelta(hours=hours, minutes=minutes)
+    if not offset:
+        return timezone.utc
+    return timezone(sign * offset)
@@ -0,0 +1,153 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Limits on outgoing fetches
+
+A Governor caps the number of simultaneous downloads, in total and per
+host, and the total download bandwidth. When downloads have to wait, the
+free slots are handed out round-robin across hosts, so one host with many
+queued links can't starve the others.
+"""
+
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import threading
+import time
+
+from URLpreview import stats
+
+
+class GovernorTimeout(Exception):
+    """Raised when waiting for a download slot takes too long"""
+
+
+class _Ticket:
+    __slots__ = ('host', 'granted')
+
+    def __init__(self, host):
+        self.host = host
+        self.granted = False
+
+
+class Governor:
+    def __init__(self, max_connections=8, per_host=2, bytes_per_second=0,
+                 timeout=30):
+        self.max_connections = max_connections  # 0 for no limit
+        self.per_host = per_host                # 0 for no limit
+        self.bytes_per_second = bytes_per_second  # 0 for no limit
+        self.timeout = timeout
+        self._condition = threading.Condition()
+        self._waiting = OrderedDict()  # host -> deque of tickets
+        self._active = {}              # host -> number of downloads
+        self._active_total = 0
+        self._bandwidth_lock = threading.Lock()
+        self._tokens = float(bytes_per_second)
+        self._updated = time.monotonic()
+
+    def _has_room(self, host):
+        if self.max_connections and \
+                self._active_total >= self.max_connections:
+            return False
+        return not self.per_host or \
+            self._active.get(host, 0) < self.per_host
+
+    def _grant(self):
+        """Hands out free slots, one host at a time. Needs the lock."""
+        granted = True
+        while granted:
+            granted = False
+            for host in list(self._waiting):
+                if not self._has_room(host):
+                    continue
+                queue = self._waiting[host]
+                ticket = queue.popleft()
+                if queue:
+                    self._waiting.move_to_end(host)  # Next host's turn
+                else:
+                    del self._waiting[host]
+                ticket.granted = True
+                self._active[host] = self._active.get(host, 0) + 1
+                self._active_total += 1
+                granted = True
+        self._condition.notify_all()
+
+    def acquire(self, host):
+        start = time.monotonic()
+        ticket = _Ticket(host)
+        with self._condition:
+            self._waiting.setdefault(host, deque()).append(ticket)
+            self._grant()
+            while not ticket.granted:
+                remaining = start + self.timeout - time.monotonic()
+                if remaining <= 0:
+                    self._waiting[host].remove(ticket)
+                    if not self._waiting[host]:
+                        del self._waiting[host]
+                    stats.incr('governor_timeouts')
+                    raise GovernorTimeout(
+                        'No download slot for %s after %ds' %
+                        (host, self.timeout))
+                self._condition.wait(remaining)
+        waited = time.monotonic() - start
+        if waited > 0.001:
+            stats.record('governor_slot_wait', waited)
+
+    def release(self, host):
+        with self._condition:
+            self._active[host] -= 1
+            if not self._active[host]:
+                del self._active[host]
+            self._active_total -= 1
+            self._grant()
+
+    @contextmanager
+    def connection(self, host):
+        """Context manager that holds a download slot for <host>"""
+        self.acquire(host)
+        try:
+            yield
+        finally:
+            self.release(host)
+
+    def throttle(self, length):
+        """Accounts for <length> downloaded bytes, and sleeps if we're over
+        the bandwidth budget"""
+        if not self.bytes_per_second:
+            return
+        with self._bandwidth_lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.bytes_per_second,
+                self._tokens + (now - self._updated) * self.bytes_per_second)
+            self._updated = now
+            self._tokens -= length
+            delay = -self._tokens / self.bytes_per_second
+        if delay > 0:
+            stats.record('governor_bandwidth_wait', delay)
+            time.sleep(delay)
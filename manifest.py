@@ -0,0 +1,101 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Declares the bundled previewers.
+
+This lets the plugin register their configuration variables and route
+URLs to them without importing their modules, which only happens when a
+previewer is used for the first time.
+"""
+
+from supybot import conf, registry
+
+try:
+    from supybot.i18n import PluginInternationalization
+    _ = PluginInternationalization('URLpreview')
+except ImportError:
+    def _(x):
+        return x
+
+
+class PreviewerSpec:
+    """Describes a previewer: where to find it, the domains it handles
+    (exactly, or any subdomain of <suffixes>) and its config variables as
+    (name, registry type, default, help, keyword arguments) tuples"""
+
+    def __init__(self, name, module, cls, domains=(), suffixes=(),
+                 variables=()):
+        self.name = name
+        self.module = module
+        self.cls = cls
+        self.domains = frozenset(domains)
+        self.suffixes = tuple(suffixes)
+        self.variables = variables
+
+    def can_handle(self, domain):
+        return domain in self.domains or domain.endswith(self.suffixes)
+
+    def register_vars(self, plugin):
+        for (name, kind, default, description, kwargs) in self.variables:
+            conf.registerGlobalValue(
+                plugin, name, kind(default, description, **kwargs))
+
+
+MANIFEST = [
+    PreviewerSpec(
+        name='npr',
+        module='npr',
+        cls='NprPreviewer',
+        suffixes=['npr.org'],
+    ),
+    PreviewerSpec(
+        name='twitter',
+        module='twitter',
+        cls='TwitterPreview',
+        domains=['twitter.com'],
+        variables=[
+            ('twitter_enabled', registry.Boolean, False,
+             _('Enable for Twitter links? (needs API key)'), {}),
+            ('twitter_api_token', registry.String, '',
+             _('Twitter API OAuth 2.0 Bearer token'), {'private': True}),
+        ],
+    ),
+    PreviewerSpec(
+        name='youtube',
+        module='youtube',
+        cls='YoutubePreviewer',
+        suffixes=['youtube.com', 'youtu.be'],
+        variables=[
+            ('youtube_enabled', registry.Boolean, False,
+             _('Enable for YouTube links? (needs API key)'), {}),
+            ('youtube_api_token', registry.String, '',
+             _('Google Simple API key'), {'private': True}),
+        ],
+    ),
+]
@@ -0,0 +1,118 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""oEmbed endpoints
+
+Many sites describe their pages in a small oEmbed JSON document, which is
+much cheaper to get than the page itself. Sites announce their endpoint
+with <link rel="alternate" type="application/json+oembed" href="…"> in
+their pages; the generic previewer reports these here, and asks the
+endpoint directly for further links to the same domain. Well-known
+providers are listed below.
+"""
+
+from urllib.parse import parse_qsl, quote, urlencode, urlsplit, urlunsplit
+
+from URLpreview import stats
+from URLpreview.cache import PreviewCache
+
+ENDPOINT_TTL = 24 * 60 * 60  # How long to remember a learned endpoint
+MAX_DOMAINS = 1024
+
+# Domain (or parent domain) -> endpoint
+PROVIDERS = {
+    'dailymotion.com': 'https://www.dailymotion.com/services/oembed',
+    'flickr.com': 'https://www.flickr.com/services/oembed/?format=json',
+    'reddit.com': 'https://www.reddit.com/oembed',
+    'slideshare.net': 'https://www.slideshare.net/api/oembed/2?format=json',
+    'soundcloud.com': 'https://soundcloud.com/oembed?format=json',
+    'open.spotify.com': 'https://open.spotify.com/oembed',
+    'tiktok.com': 'https://www.tiktok.com/oembed',
+    'vimeo.com': 'https://vimeo.com/api/oembed.json',
+}
+
+endpoints = PreviewCache(max_entries=MAX_DOMAINS, ttl=ENDPOINT_TTL,
+                         max_stale=0)
+
+
+def get_domain(url):
+    return (urlsplit(url).hostname or '').lower()
+
+
+def find_provider(domain):
+    while domain:
+        if domain in PROVIDERS:
+            return PROVIDERS[domain]
+        domain = domain.partition('.')[2]
+    return None
+
+
+def endpoint_for(url):
+    """Returns the oEmbed request URL for <url>, if we know an endpoint"""
+    domain = get_domain(url)
+    endpoint = find_provider(domain)
+    if endpoint is None:
+        entry = endpoints.get(domain)
+        if entry is None or not entry.is_fresh():
+            return None
+        endpoint = entry.value
+    separator = '&' if '?' in endpoint else '?'
+    return endpoint + separator + 'url=' + quote(url, safe='')
+
+
+def forget(url):
+    """Forgets the learned endpoint for the domain of <url>, because it
+    failed. Endpoints of PROVIDERS are kept."""
+    domain = get_domain(url)
+    if find_provider(domain) is None and endpoints.get(domain) is not None:
+        endpoints.delete(domain)
+        stats.incr('oembed_endpoints_forgotten')
+
+
+def learn(page_url, href):
+    """Remembers the endpoint in <href>, announced by the page <page_url>,
+    for its domain"""
+    if not href:
+        return
+    domain = get_domain(page_url)
+    if find_provider(domain) is not None:
+        return
+    # Strip the page's own URL from the href to get the endpoint
+    parts = urlsplit(href)
+    if parts.scheme not in ('http', 'https'):
+        return
+    query = [(key, value) for (key, value) in parse_qsl(parts.query)
+             if key != 'url']
+    endpoint = urlunsplit((parts.scheme, parts.netloc, parts.path,
+                           urlencode(query), ''))
+    entry = endpoints.get(domain)
+    if entry is None or entry.value != endpoint:
+        stats.incr('oembed_endpoints_learned')
+    endpoints.put(domain, endpoint)
+
@@ -28,10 +28,13 @@
 #
 ###
 
+import sys
+
 import regex as re
 
 
-from supybot import callbacks, ircmsgs  # utils, plugins, ircutils,
+from supybot import callbacks, conf, ircmsgs, ircutils  # utils, plugins,
+from supybot.commands import wrap
 
 try:
     from supybot.i18n import PluginInternationalization
@@ -42,7 +45,12 @@ except ImportError:
     def _(x):
         return x
 
-from .previewers import generic
+from . import proxies, stats
+from .canonical import canonicalize
+from .prefetch import Prefetcher
+from .preview import DEFAULT_OPTIONS, format_preview
+from .profiling import Profiler
+from .throttle import RateLimiter, RecentURLs
 from .previewer import PreviewerCollection
 
 
@@ -54,6 +62,25 @@ class URLpreview(callbacks.Plugin):  # pylint: disable=too-many-ancestors
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.previewers = PreviewerCollection()
+        self.recent_urls = RecentURLs()
+        self.rate_limiter = RateLimiter()
+        self.profiler = Profiler()
+        self.prefetcher = Prefetcher(self._prefetch,
+                                     lambda: self.previewers.busy())
+        self.daemon = None  # daemon.Client, once daemon_socket is set
+
+    def die(self):
+        self.prefetcher.stop()
+        self.previewers.retire()
+        proxies.pool.stop()
+        self.profiler.stop()
+        if self.daemon is not None:
+            self.daemon.close()
+        # api imports requests, so it's only loaded once a previewer uses it
+        api = sys.modules.get(__package__ + '.api')
+        if api is not None:
+            api.close()
+        super().die()
 
     def doPrivmsg(self, irc, msg):
         channel = msg.args[0]
@@ -63,35 +90,151 @@ class URLpreview(callbacks.Plugin):  # pylint: disable=too-many-ancestors
         url = find_url(text)
         if url is None:
             return  # No URL found
-        domain = get_domain(url)
+        url = canonicalize(url)
+        self.prefetcher.check(url)
+        key = (irc.network, channel)
+        rate = self.registryValue('rate_limit', channel)
+        if rate and not self.rate_limiter.available(key, rate):
+            stats.incr('rate_limited')
+            return
+        window = self.registryValue('repeat_window', channel)
+        if self.recent_urls.seen(key, url, window):
+            stats.incr('repeats_suppressed')
+            return  # Previewed here just now
+        options = self._format_options(channel)
+        preview = self._get_preview(url, options)
 
+        # Handle the result
+        text = format_preview(preview, options)
+        if text is None:
+            return
+        if not self.registryValue('colors', channel):
+            text = ircutils.stripFormatting(text)
+        if rate and not self.rate_limiter.consume(key, rate):
+            stats.incr('rate_limited')
+            return
+        irc.queueMsg(ircmsgs.privmsg(channel, text))
+        # Only now, so links that couldn't be previewed can be tried again
+        self.recent_urls.record(key, url)
+
+    def _get_preview(self, url, options=DEFAULT_OPTIONS):
+        path = self.registryValue('daemon_socket')
+        if path:
+            if self.daemon is None:
+                # Imported here, so daemon.py can be run with python -m
+                from .daemon import Client
+                self.daemon = Client()
+            try:
+                # The daemon formats the preview for us
+                return self.daemon.get_preview(path, url, options)
+            except ConnectionError:  # daemon.Unavailable
+                stats.incr('daemon_fallbacks')
+        domain = get_domain(url)
         preview = None
+        # Keep using this collection, even if the plugin is reloaded meanwhile
+        previewers = self.previewers
         # Find previewer
-        previewer = self.previewers.get_previewer(domain)
+        previewer = previewers.get_previewer(domain)
         if previewer is not None:
-            preview = previewer.get_preview(self, url)
+            with previewers.running(), \
+                    self._profile(url, domain, type(previewer).__name__):
+                preview = previewer.get_preview(self, url)
+
+        elif self.registryValue('generic_enabled'):
+            generic = previewers.get_generic()
+            if generic.can_handle(domain):
+                with previewers.running(), \
+                        self._profile(url, domain, 'generic'):
+                    preview = generic.handle(url)
+        return preview
+
+    def doTopic(self, irc, msg):
+        if len(msg.args) > 1:
+            self._prefetch_topic(msg.args[0], msg.args[1])
+
+    def do332(self, irc, msg):
+        # RPL_TOPIC, the topic of a channel we just joined
+        self._prefetch_topic(msg.args[1], msg.args[2])
+
+    def _prefetch_topic(self, channel, topic):
+        if not self.registryValue('prefetch', channel):
+            return
+        for url in find_urls(topic):
+            self.prefetcher.add(canonicalize(url))
+
+    def _prefetch(self, url):
+        # Previews are cached by the previewers, so this warms the caches
+        self._get_preview(url)
+
+    def _format_options(self, channel):
+        return {
+            'title_length': self.registryValue('title_length', channel),
+            'description_length':
+                self.registryValue('description_length', channel),
+        }
+
+    def _profile(self, url, domain, previewer):
+        return self.profiler.track(
+            url, domain, previewer,
+            self.registryValue('profile_threshold'),
+            self.registryValue('profile_memory'))
+
+    def stats(self, irc, msg, args):
+        """takes no arguments
+
+        Returns statistics about the downloads done for previews."""
+        irc.reply(stats.summary())
+    stats = wrap(stats, ['admin'])
+
+    def slowpreviews(self, irc, msg, args):
+        """takes no arguments
+
+        Lists the slowest recent previews that took longer than
+        profile_threshold, with the number of their profile."""
+        profiles = self.profiler.slowest()
+        if not profiles:
+            irc.reply(_('No slow previews recently.'))
+            return
+        irc.reply('; '.join('#%d %.1fs %s %s' % (profile.id,
+                                                 profile.duration,
+                                                 profile.previewer,
+                                                 profile.url)
+                            for profile in profiles))
+    slowpreviews = wrap(slowpreviews, ['owner'])
+
+    def dumpprofile(self, irc, msg, args, id):
+        """<number>
+
+        Writes the profile with the given <number> (see slowpreviews) to the
+        data directory."""
+        profile = self.profiler.get(id)
+        if profile is None:
+            irc.error(_('There is no profile #%d.') % id)
+            return
+        path = conf.supybot.directories.data.dirize(
+            'URLpreview-profile-%d.txt' % id)
+        profile.dump(path)
+        irc.reply(_('Wrote profile #%d to %s') % (id, path))
+    dumpprofile = wrap(dumpprofile, ['owner', 'positiveInt'])
 
-        elif generic.can_handle(domain):
-            if self.registryValue('generic_enabled'):
-                preview = generic.handle(url)
 
-        # Handle the result
-        if preview is None:
-            return
-        irc.queueMsg(ircmsgs.privmsg(channel, preview))
+# Something that looks vaguely like a URL
+URL_PATTERN = re.compile(
+    r'http[s]?://(?:\p{Letter}|\p{Number}|[$-_@.&+]|[!*\(\),]'
+    + r'|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
 
 
 def find_url(text):
-    # First, find something that looks vaguely like a URL
-    url_pattern = re.compile(
-        r'http[s]?://(?:\p{Letter}|\p{Number}|[$-_@.&+]|[!*\(\),]'
-        + r'|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
-    match = url_pattern.search(text)
+    match = URL_PATTERN.search(text)
     if match is None:
         return None
     return match.group(0)
 
 
+def find_urls(text):
+    return [match.group(0) for match in URL_PATTERN.finditer(text)]
+
+
 def get_domain(url):
     domain = re.sub(r'https?://', '', url)  # remove scheme part
     domain = re.sub(r'/.*', '', domain)  # remove everything after first slash
@@ -0,0 +1,123 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Speculative prefetching
+
+Links in channel topics get pasted (and asked about) a lot. The Prefetcher
+previews them ahead of time in a background thread, so the caches are warm
+when somebody pastes them. It's rate-limited and waits while live previews
+are being made, so it doesn't compete with them.
+"""
+
+from collections import OrderedDict
+import queue
+import threading
+import time
+
+from supybot import log
+
+from URLpreview import stats
+from URLpreview.throttle import TokenBucket
+
+RATE = 10                 # Max. prefetches per minute
+MAX_QUEUE = 32            # URLs waiting to be prefetched
+MAX_REMEMBERED = 256      # Prefetched URLs remembered to count hits
+IDLE_WAIT = 0.5           # Seconds between checks if we may go ahead
+
+
+class Prefetcher:
+    def __init__(self, fetch, is_busy, rate=RATE):
+        self.fetch = fetch      # fetch(url) makes (and caches) a preview
+        self.is_busy = is_busy  # Returns True while live previews are made
+        self.bucket = TokenBucket(rate)
+        self._queue = queue.Queue(MAX_QUEUE)
+        self._pending = set()
+        self._prefetched = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+
+    def add(self, url):
+        """Queues <url> to be prefetched, unless it was already"""
+        with self._lock:
+            if self._stopped or url in self._pending or \
+                    url in self._prefetched:
+                return
+            try:
+                self._queue.put_nowait(url)
+            except queue.Full:
+                stats.incr('prefetch_dropped')
+                return
+            self._pending.add(url)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='URLpreview prefetcher',
+                    daemon=True)
+                self._thread.start()
+
+    def check(self, url):
+        """Called for every URL pasted, counts prefetch hits"""
+        with self._lock:
+            hit = self._prefetched.pop(url, False)
+        if hit:
+            stats.incr('prefetch_hits')
+
+    def _run(self):
+        while True:
+            url = self._queue.get()
+            if not self._wait():
+                return
+            try:
+                self.fetch(url)
+            except Exception as e:
+                log.info('URLpreview.prefetch: "%s", exception %s' %
+                         (url, repr(e)))
+            stats.incr('prefetches')
+            with self._lock:
+                self._pending.discard(url)
+                self._prefetched[url] = True
+                while len(self._prefetched) > MAX_REMEMBERED:
+                    self._prefetched.popitem(last=False)
+
+    def _wait(self):
+        """Waits until no live previews are running and the rate limit
+        allows another prefetch. Returns False if we were stopped."""
+        while not self._stopped:
+            if not self.is_busy() and self.bucket.consume():
+                return True
+            time.sleep(IDLE_WAIT)
+        return False
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+        try:
+            self._queue.put_nowait(None)  # Wakes up the thread
+        except queue.Full:
+            pass
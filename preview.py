@@ -0,0 +1,95 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Structured previews
+
+Previewers return a Preview record instead of a finished IRC message.
+Records can be cached as they are; they are turned into text when they
+are sent, with the settings of the channel they are sent to and with
+relative times ("5 minutes ago") computed at that moment.
+"""
+
+
+class Preview:
+    __slots__ = ('kind', 'title', 'description', 'author', 'username',
+                 'published', 'counters', 'flags')
+
+    # Flags
+    INSECURE = 1  # Fetched without a valid TLS certificate
+    VERIFIED = 2  # The author has been verified by the site
+    LIVE = 4      # Happening right now (live stream)
+    UPCOMING = 8  # Scheduled for the future (premiere, stream)
+
+    def __init__(self, kind, title=None, description=None, author=None,
+                 username=None, published=None, counters=None, flags=0):
+        self.kind = kind                # Selects the formatter, see below
+        self.title = title
+        self.description = description
+        self.author = author            # Display name of author/channel
+        self.username = username        # Handle of the author
+        self.published = published      # datetime
+        self.counters = counters or {}  # e.g. views, followers
+        self.flags = flags
+
+    def has(self, flag):
+        return bool(self.flags & flag)
+
+    def replace(self, **changes):
+        """Returns a copy of this preview with <changes> applied"""
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        return Preview(**values)
+
+    def __repr__(self):
+        return '<Preview %s %r>' % (self.kind, self.title or self.description)
+
+
+# Formatting options, overridden by the channel's configuration
+DEFAULT_OPTIONS = {
+    'title_length': 140,        # length after which titles are cut
+    'description_length': 280,  # length after which descriptions are cut
+}
+
+_formatters = {}
+
+
+def register_formatter(kind, formatter):
+    """Registers formatter(preview, options) -> str for previews of <kind>.
+    Previewers call this when their module is imported."""
+    _formatters[kind] = formatter
+
+
+def format_preview(preview, options=None):
+    """Returns the message for <preview>, or None if there is nothing to
+    say. Plain strings (from older previewers) are passed through."""
+    if preview is None or isinstance(preview, str):
+        return preview
+    if options is None:
+        options = DEFAULT_OPTIONS
+    return _formatters[preview.kind](preview, options)
@@ -28,9 +28,25 @@
 #
 ###
 
+from contextlib import contextmanager
 from inspect import getmembers, isclass
-from importlib import import_module, reload
+from importlib import import_module
+from importlib.util import module_from_spec
 from pkgutil import iter_modules
+import sys
+import threading
+import time
+
+from supybot import log
+
+from . import stats
+from .manifest import MANIFEST
+
+PACKAGE = 'URLpreview.previewers'
+
+# Modules loaded since this module was (re)loaded, i.e. during this load of
+# the plugin
+_current = set()
 
 
 class Previewer:
@@ -39,7 +55,7 @@ class Previewer:
         raise NotImplementedError
 
     def get_preview(self, plugin, url):
-        '''Returns a preview message for the url,
+        '''Returns a preview.Preview (or a ready-made message) for the url,
            or None if the preview fails'''
         raise NotImplementedError
 
@@ -54,36 +70,144 @@ class Previewer:
 
 
 class PreviewerCollection:
-    """Collection object that looks for all previewers upon creation"""
+    """Collection of all previewers.
+
+    Previewers declared in manifest.py are imported when they are first
+    needed, any other module in previewers/ is imported upon creation.
+
+    When the plugin is reloaded, a new collection loads new versions of the
+    modules next to the old ones and swaps them in once they are complete,
+    so previews still running on the old collection finish with the old
+    code. The objects a module lists in its PERSISTENT attribute (caches,
+    connection pools, …) are carried over to the new version."""
 
     def __init__(self):
-        self.previewers = []
-        package = import_module('URLpreview.previewers')
+        self.specs = list(MANIFEST)
+        self.previewers = []  # Previewers not declared in the manifest
+        self._instances = {}  # Manifest name -> previewer instance
+        self._modules = {}    # Name -> the version of it we use
+        self._lock = threading.RLock()
+        self._running = 0     # Previews in progress
+        self._retired = None  # Time we were replaced by a new collection
+        declared = {PACKAGE + '.' + spec.module for spec in self.specs}
+        declared.add(PACKAGE + '.generic')
+        package = import_module(PACKAGE)
 
         for _, name, ispkg in iter_modules(
                 package.__path__, package.__name__ + '.'):
-            if not ispkg:
-                module = import_module(name)
-                # Reload for the case that we are reloaded
-                reload(module)
+            if not ispkg and name not in declared:
+                module = self._import(name)
                 classes = getmembers(module, isclass)
                 for (_, c) in classes:
                     if c is not Previewer and issubclass(c, Previewer):
                         self.previewers.append(c())
 
+    def _import(self, name):
+        """Imports the module <name>, and loads a new version of it if it was
+        imported before the plugin was (re)loaded. Returns the version this
+        collection loaded, even if a newer collection has loaded a new one
+        since."""
+        module = self._modules.get(name)
+        if module is not None:
+            return module
+        with self._lock:
+            if name in self._modules:
+                return self._modules[name]
+            if name in sys.modules and name not in _current:
+                module = swap_module(name)
+            else:
+                module = import_module(name)
+            _current.add(name)
+            self._modules[name] = module
+            return module
+
+    def _instance(self, spec):
+        instance = self._instances.get(spec.name)
+        if instance is None:
+            with self._lock:
+                instance = self._instances.get(spec.name)
+                if instance is None:
+                    module = self._import(PACKAGE + '.' + spec.module)
+                    instance = getattr(module, spec.cls)()
+                    self._instances[spec.name] = instance
+        return instance
+
+    @contextmanager
+    def running(self):
+        """Context manager around making a preview with this collection"""
+        with self._lock:
+            self._running += 1
+        try:
+            yield
+        except Exception:
+            if self._retired is not None:
+                stats.incr('reload_dropped')
+            raise
+        finally:
+            with self._lock:
+                self._running -= 1
+                drained = self._retired is not None and self._running == 0
+            if drained:
+                stats.record('reload_drain', time.monotonic() - self._retired)
+
+    def busy(self):
+        """Returns True while previews are being made"""
+        return self._running > 0
+
+    def retire(self):
+        """Called when the collection is replaced, i.e. the plugin is
+        unloaded or reloaded. Previews in progress are left to finish."""
+        with self._lock:
+            self._retired = time.monotonic()
+            running = self._running
+        stats.incr('reload_in_flight', running)
+        if running == 0:
+            stats.record('reload_drain', 0)
+
     def get_previewer(self, domain):
         """Returns a previewer that claims to be able to handle <domain>"""
+        for spec in self.specs:
+            if spec.can_handle(domain):
+                return self._instance(spec)
         for previewer in self.previewers:
             if previewer.can_handle(domain):
                 return previewer
         return None
 
+    def get_generic(self):
+        """Returns the generic previewer module"""
+        return self._import(PACKAGE + '.generic')
+
     def configure(self, plugin, advanced):
         """Calls the configure() method of each previewer"""
+        for spec in self.specs:
+            self._instance(spec).configure(plugin, advanced)
         for previewer in self.previewers:
             previewer.configure(plugin, advanced)
 
     def register_vars(self, plugin):
-        """Calls the register_vars() method of each previewer"""
+        """Registers the variables of each previewer"""
+        for spec in self.specs:
+            spec.register_vars(plugin)
         for previewer in self.previewers:
             previewer.register_vars(plugin)
+
+
+def swap_module(name):
+    """Loads a new version of the module <name>, carries its PERSISTENT
+    objects over from the current version, and replaces the current version
+    with it. Code still running in the current version keeps using it."""
+    start = time.monotonic()
+    old = sys.modules[name]
+    module = module_from_spec(old.__spec__)
+    old.__spec__.loader.exec_module(module)
+    for attr in getattr(module, 'PERSISTENT', ()):
+        if hasattr(old, attr):
+            setattr(module, attr, getattr(old, attr))
+    sys.modules[name] = module
+    (package, _, attr) = name.rpartition('.')
+    setattr(sys.modules[package], attr, module)
+    elapsed = time.monotonic() - start
+    stats.record('reload', elapsed)
+    log.debug('URLpreview: reloaded %s in %.1fms' % (name, elapsed * 1000))
+    return module
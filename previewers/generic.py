@@ -28,11 +28,15 @@
 #
 ###
 
-from bs4 import BeautifulSoup
-from dateutil.parser import parse, ParserError
+from bs4 import BeautifulSoup, UnicodeDammit
+import codecs
 import json
 import regex as re
 import requests
+import threading
+import time
+from urllib.parse import urljoin, urlsplit
+from urllib3.util.request import ACCEPT_ENCODING
 
 # Optional support for humanize
 try:
@@ -42,22 +46,59 @@ except ImportError:
 
 from supybot import log
 
+from URLpreview import dates, oembed, proxies, resolver, sites, stats
+from URLpreview.buffers import BufferPool
+from URLpreview.cache import PreviewCache
+from URLpreview.canonical import canonicalize
+from URLpreview.governor import Governor
+from URLpreview.preview import Preview, register_formatter
+
 
 # The generic previewer isn't implemented as a Previewer instance
 # to ensure it's only used as the last resort.
 
 MAX_SIZE = 1 * 1024 * 1024    # Max size to download per attempt in bytes
-TIMEOUT = 10                  # Timeout per attempt in seconds
+#                               (applies to both wire and decoded bytes)
+MAX_COMPRESSION_RATIO = 50    # Abort if the body decompresses more than this
+CHUNK_SIZE = 100 * 1024       # Bytes to read per iteration
+MAX_IDLE_BUFFERS = 4          # Download buffers to keep for reuse
+MAX_CONNECTIONS = 8           # Max. simultaneous downloads (0: no limit)
+MAX_CONNECTIONS_PER_HOST = 2  # … to the same host (0: no limit)
+MAX_BYTES_PER_SECOND = 0      # Total download bandwidth (0: no limit)
+TIMEOUT = 10                  # Timeout for connecting and each read
+MAX_DOWNLOAD_TIME = 15        # Max. seconds per attempt, however slowly the
+#                               data trickles in
+MAX_REDIRECTS = 10
 ATTEMPT_INSECURE = True       # Should a connection that fails because of
 #                               certificate validation be retried?
-MAX_TITLE_LENGTH = 140        # length after which the title will be cut
-MAX_DESCRIPTION_LENGTH = 280  # length after which the description will be cut
 
 FIREFOX_UA = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:81.0) ' + \
           'Gecko/20100101 Firefox/81.0'
 HONEST_UA = 'limnoria-urlpreview-bot-1'
 GOOGLEBOT_UA = 'Googlebot'
 
+CACHE_SIZE = 1024             # Number of previews to keep in memory
+CACHE_TTL = 10 * 60           # Seconds until a cached preview is revalidated
+HOT_HITS = 3                  # Previews requested this often are hot:
+STALE_WHILE_REVALIDATE = 60 * 60  # they are served this long after expiry
+#                                   while being revalidated in the background
+
+REDIRECT_CACHE_SIZE = 4096    # Number of redirect chains to remember
+REDIRECT_TTL = 24 * 60 * 60   # How long to remember permanent redirects
+TEMPORARY_REDIRECT_TTL = 60 * 60  # … and all other redirects
+
+SNIFF_SIZE = 4 * 1024         # Bytes to search for <meta charset>
+CHARSET_PATTERN = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.I)
+META_CHARSET_PATTERN = re.compile(
+    rb'<meta[^>]+charset\s*=\s*["\']?([\w.:-]+)', re.I)
+BOMS = [
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+NOT_MODIFIED = object()       # Returned by fetch() on 304 Not Modified
+
 DOMAIN_BLACKLIST = [
     # Blacklist domains that shouldn't be accessed or don't work
     'local',
@@ -77,98 +118,412 @@ DOMAIN_BLACKLIST = [
     'outline.com',
 ]
 
+# Carried over to the new version of this module when the plugin is
+# reloaded (see previewer.py), so changes to the settings above that
+# they use only take effect after a restart
+PERSISTENT = ('session', 'governor', 'buffer_pool', 'preview_cache',
+              'redirect_cache')
+
+# Connects through the caching resolver, which also refuses internal hosts
+session = resolver.new_session()
+session.max_redirects = MAX_REDIRECTS
+
+governor = Governor(max_connections=MAX_CONNECTIONS,
+                    per_host=MAX_CONNECTIONS_PER_HOST,
+                    bytes_per_second=MAX_BYTES_PER_SECOND)
+
+# Large enough for MAX_SIZE plus the chunk that went over it
+buffer_pool = BufferPool(MAX_SIZE + CHUNK_SIZE, max_idle=MAX_IDLE_BUFFERS)
+
+preview_cache = PreviewCache(max_entries=CACHE_SIZE, ttl=CACHE_TTL)
+# Maps URLs to the (final URL, number of hops) they redirected to
+redirect_cache = PreviewCache(max_entries=REDIRECT_CACHE_SIZE,
+                              ttl=REDIRECT_TTL, max_stale=0)
+
 
 def can_handle(domain):
     return not is_domain_blacklisted(domain)
 
 
 def handle(url):
+    """Returns a preview for <url>, from the cache if possible"""
+    target = resolve_redirects(url)
+    entry = preview_cache.get(target)
+    if entry is None:
+        stats.incr('cache_misses')
+        return revalidate(url, target, None)
+    if entry.is_fresh():
+        stats.incr('cache_hits')
+        return entry.value
+    # Popular previews are answered from the cache while they are refreshed
+    # in the background
+    if entry.hits >= HOT_HITS and \
+            time.monotonic() < entry.expires + STALE_WHILE_REVALIDATE:
+        stats.incr('cache_stale_hits')
+        if preview_cache.claim_refresh(entry):
+            threading.Thread(target=revalidate_in_background,
+                             args=(url, target, entry), daemon=True).start()
+        return entry.value
+    return revalidate(url, target, entry)
+
+
+def revalidate_in_background(url, target, entry):
+    """Runs revalidate() in a thread of its own. Whatever happens, <entry>
+    can be claimed for refreshing again afterwards."""
+    try:
+        revalidate(url, target, entry)
+    except Exception as e:
+        log.info('URLpreview.generic.revalidate: "%s", exception %s' %
+                 (target, repr(e)))
+    finally:
+        entry.refreshing = False
+
+
+def revalidate(url, target, entry):
+    """Fetches a preview for <target>, which <url> redirects to, and stores it
+    in the cache. If there is an <entry> already, the request is made
+    conditional. Pages with a known oEmbed endpoint aren't fetched at all."""
+    preview = fetch_oembed(target)
+    if preview is not None:
+        stats.incr('oembed_page_fetches_avoided')
+        stats.incr('cache_refreshed' if entry is not None else 'cache_stored')
+        preview_cache.put(target, preview)
+        return preview
+    validators = entry.validators() if entry is not None else {}
+    preview, r = fetch(target, validators)
+    if r is not None:
+        remember_redirects(url, r)
+    if preview is NOT_MODIFIED and entry is not None:
+        stats.incr('cache_not_modified')
+        preview_cache.refresh(target)
+        return entry.value
+    if preview is None or preview is NOT_MODIFIED:
+        if entry is not None:
+            # Keep serving what we have
+            entry.refreshing = False
+            return entry.value
+        return None
+    if not r.ok:
+        # Errors are often temporary (503, 429), so they aren't cached, and
+        # don't replace what we have
+        stats.incr('cache_errors_skipped')
+        if entry is not None:
+            entry.refreshing = False
+            return entry.value
+        return preview
+    stats.incr('cache_refreshed' if entry is not None else 'cache_stored')
+    # Stored under the URL handle() looks up: the target, unless we were
+    # redirected. r.url may differ from it anyway, as requests
+    # percent-encodes paths and punycodes hostnames.
+    key = canonicalize(r.url) if r.history else target
+    preview_cache.put(key, preview,
+                      etag=r.headers.get('ETag'),
+                      last_modified=r.headers.get('Last-Modified'))
+    return preview
+
+
+def resolve_redirects(url):
+    """Returns the URL that <url> redirected to last time, or <url>"""
+    entry = redirect_cache.get(url)
+    if entry is None or not entry.is_fresh():
+        return url
+    stats.incr('redirect_cache_hits')
+    final_url, hops = entry.value
+    stats.incr('redirect_hops_saved', hops)
+    return final_url
+
+
+def remember_redirects(url, r):
+    """Stores where <url> ended up after the redirects in <r>"""
+    if not r.history:
+        # No redirects, or we went to the remembered target directly
+        return
+    final_url = canonicalize(r.url)
+    if final_url == url:
+        return
+    permanent = True
+    for hop in r.history:
+        stats.record('redirect_hop', hop.elapsed.total_seconds())
+        permanent = permanent and hop.is_permanent_redirect
+    ttl = REDIRECT_TTL if permanent else TEMPORARY_REDIRECT_TTL
+    redirect_cache.put(url, (final_url, len(r.history)), ttl=ttl)
+
+
+def fetch_oembed(url):
+    """Returns a preview for <url> from its site's oEmbed endpoint, or None
+    if there is no known endpoint or it fails"""
+    endpoint = oembed.endpoint_for(url)
+    if endpoint is None:
+        return None
+    try:
+        with buffer_pool.borrow() as buffer:
+            r = download(endpoint, buffer, user_agent=HONEST_UA,
+                         headers={'Accept': 'application/json'})
+            r.raise_for_status()
+            data = json.loads(bytes(r.content))
+    except Exception as e:
+        log.info('URLpreview.generic.fetch_oembed: trying "%s", exception %s'
+                 % (endpoint, repr(e)))
+        stats.incr('oembed_failures')
+        oembed.forget(url)
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get('title'), str):
+        stats.incr('oembed_failures')
+        oembed.forget(url)
+        return None
+    author = data.get('author_name') or data.get('provider_name')
+    return make_preview(True, {
+        'title': sanitize(data['title']),
+        'description': None,
+        'date': None,
+        'author': sanitize(author) if isinstance(author, str) else None,
+    })
+
+
+def fetch(url, validators=None):
+    """Downloads <url> and returns (preview, response).
+    preview is NOT_MODIFIED if <validators> matched."""
+    with buffer_pool.borrow() as buffer:
+        return fetch_into(url, buffer, validators)
+
+
+def fetch_into(url, buffer, validators):
     secure = True
     try:
-        r = download(url)
+        r = download(url, buffer, headers=validators)
     except requests.exceptions.SSLError:
         secure = False
     except Exception as e:
         log.info('URLpreview.generic.handle: trying "%s", exception %s' %
                  (url, repr(e)))
-        return
+        return None, None
     # Retry without verification?
     if ATTEMPT_INSECURE and not secure:
         try:
-            r = download(url, verify=False)
+            r = download(url, buffer, verify=False, headers=validators)
         except Exception as e:
             log.info('URLpreview.generic.handle: trying "%s", exception %s' %
                      (url, repr(e)))
-            return
+            return None, None
+
+    if r.status_code == 304:
+        return NOT_MODIFIED, r
 
     if not r.headers['content-type'].startswith('text/html'):
-        return
+        return None, r
 
     if not r.ok:
-        return format_msg(secure, {
+        return make_preview(secure, {
             'title': 'Error %d' % r.status_code,
             'description': r.reason,
             'date': None,
-        })
+        }), r
 
-    meta = get_meta(r.content)
+    meta = parse(r)
     # If meta['description'] or meta['title'] is None, try again with more
     # honest user agent
     # Rationale: many sites refuse to talk to non-browser UAs, but now
     # some paywalls appear *only* for non-browser UAs.
 
-    # If meta['description'] and meta['title'] exist, then return early
-    if meta['title'] is not None and meta['description'] is not None:
-        return format_msg(secure, meta)
+    # If we have what we need, then return early
+    if is_complete(meta):
+        return make_preview(secure, meta), r
 
     # Don't reattempt if TLS didn't work before and insecure attempts
     # are switched off
     if not secure and not ATTEMPT_INSECURE:
-        return format_msg(secure, meta)
+        return make_preview(secure, meta), r
     try:
-        r = download(url, verify=secure, user_agent=HONEST_UA)
+        r = download(url, buffer, verify=secure, user_agent=HONEST_UA)
     except Exception as e:
         log.info('URLpreview.generic.handle: trying "%s", exception %s' %
                  (url, repr(e)))
+        # The buffer may have been partly overwritten, stick with what we have
+        return make_preview(secure, meta), r
 
-    meta = get_meta(r.content)
+    meta = parse(r)
 
-    if meta['title'] is not None and meta['description'] is not None:
-        return format_msg(secure, meta)
+    if is_complete(meta):
+        return make_preview(secure, meta), r
 
     # Still no luck? Pretend we are Googlebot and hope the site
     # isn't checking our reverse DNS as it should
     try:
-        r = download(url, verify=secure, user_agent=GOOGLEBOT_UA)
+        r = download(url, buffer, verify=secure, user_agent=GOOGLEBOT_UA)
     except Exception as e:
         log.info('URLpreview.generic.handle: trying "%s", exception %s' %
                  (url, repr(e)))
+        # The buffer may have been partly overwritten, stick with what we have
+        return make_preview(secure, meta), r
 
-    meta = get_meta(r.content)
+    meta = parse(r)
 
-    return format_msg(secure, meta)
+    return make_preview(secure, meta), r
 
 
-def download(url, verify=True, user_agent=FIREFOX_UA):
-    headers = {
+def download(url, buffer, verify=True, user_agent=FIREFOX_UA, headers=None):
+    """Downloads <url> into <buffer> (from buffer_pool). r.content is a
+    memoryview into the buffer and only valid while the buffer is."""
+    headers = dict(headers or {})
+    headers.update({
         'User-Agent': user_agent,
-    }
-    r = requests.get(
-        url, headers=headers, timeout=TIMEOUT, stream=True, verify=verify)
-
-    data = []
+        # gzip and deflate, plus br and zstd if brotli/zstandard are installed
+        'Accept-Encoding': ACCEPT_ENCODING,
+    })
+    with governor.connection(urlsplit(url).hostname):
+        return read_into(url, buffer, verify, headers)
+
+
+def read_into(url, buffer, verify, headers):
+    with proxies.configured_pool().request() as proxy:
+        hooks = None
+        if proxy is not None:
+            # The proxy resolves the hosts, so we can only check them: this
+            # one, and each one we are redirected to
+            vet_host(urlsplit(url).hostname)
+            hooks = {'response': vet_redirect}
+        r = session.get(url, headers=headers, timeout=TIMEOUT, stream=True,
+                        verify=verify, proxies=proxy, hooks=hooks)
+
+    view = memoryview(buffer)
     length = 0
-
-    for chunk in r.iter_content(100*1024):
-        data.append(chunk)
-        length += len(chunk)
-        if length > MAX_SIZE:
+    wire_length = 0
+    deadline = time.monotonic() + MAX_DOWNLOAD_TIME
+
+    # With decode_content, reads undo the Content-Encoding on the fly;
+    # r.raw.tell() counts the bytes that actually came over the wire.
+    # read1() returns whatever has arrived instead of waiting for a full
+    # chunk, so a slow drip can't keep us past the deadline.
+    r.raw.decode_content = True
+    while length <= MAX_SIZE:
+        data = r.raw.read1(CHUNK_SIZE)
+        if not data:
+            break
+        view[length:length + len(data)] = data
+        length += len(data)
+        if time.monotonic() > deadline:
+            r.close()
+            stats.incr('download_deadlines')
+            raise requests.exceptions.ReadTimeout(
+                '"%s" took longer than %ds' % (url, MAX_DOWNLOAD_TIME))
+        governor.throttle(r.raw.tell() - wire_length)
+        wire_length = r.raw.tell()
+        if wire_length > MAX_SIZE:
             break
+        if length > CHUNK_SIZE and \
+                length > wire_length * MAX_COMPRESSION_RATIO:
+            log.info('URLpreview.generic.download: "%s" looks like a '
+                     'decompression bomb, giving up' % url)
+            stats.incr('decompression_bombs')
+            break
+    r.close()
 
-    r._content = b''.join(data)
+    stats.incr('bytes_wire', r.raw.tell())
+    stats.incr('bytes_decoded', length)
+    r._content = view[:length]
     return r
 
 
+def vet_host(host):
+    """Raises resolver.BlockedAddressError if <host> is internal"""
+    try:
+        resolver.resolve(host)
+    except OSError:
+        pass  # Maybe the proxy knows it
+
+
+def vet_redirect(r, *args, **kwargs):
+    """Response hook, raises resolver.BlockedAddressError before requests
+    follows a redirect to an internal host"""
+    if r.is_redirect:
+        try:
+            vet_host(urlsplit(urljoin(r.url, r.headers['Location'])).hostname)
+        except resolver.BlockedAddressError:
+            r.close()
+            raise
+
+
+def get_text(r):
+    """Decodes the body of <r>, using its BOM, the charset from the
+    Content-Type header or a <meta> tag near the start, and only detects
+    the encoding as a last resort"""
+    content = r.content  # a memoryview, decoding it doesn't copy it again
+    for (source, encoding) in [
+        ('charset_bom', find_bom(bytes(content[:3]))),
+        ('charset_header', find_charset(r.headers.get('content-type', ''))),
+        ('charset_meta', find_meta_charset(content[:SNIFF_SIZE])),
+    ]:
+        if encoding is not None:
+            stats.incr(source)
+            return str(content, encoding, 'replace')
+    # Most pages without a declared charset are UTF-8 anyway
+    try:
+        text = str(content, 'utf-8')
+        stats.incr('charset_utf8')
+        return text
+    except UnicodeDecodeError:
+        pass
+    stats.incr('charset_detected')
+    return UnicodeDammit(bytes(content), is_html=True).unicode_markup or ''
+
+
+def find_charset(content_type):
+    """Returns the charset from a Content-Type value, if it's a known one"""
+    match = CHARSET_PATTERN.search(content_type)
+    if match is None:
+        return None
+    return known_encoding(match.group(1))
+
+
+def find_bom(content):
+    for (bom, encoding) in BOMS:
+        if content.startswith(bom):
+            return encoding
+    return None
+
+
+def find_meta_charset(head):
+    """Looks for <meta charset> or <meta http-equiv> in the bytes <head>"""
+    match = META_CHARSET_PATTERN.search(head)
+    if match is None:
+        return None
+    return known_encoding(match.group(1).decode('ascii', errors='ignore'))
+
+
+def known_encoding(name):
+    try:
+        return codecs.lookup(name.strip()).name
+    except LookupError:
+        return None
+
+
+def parse(r):
+    """Returns the metadata of the page in <r>, using the site's profile if
+    there is one, and remembers its oEmbed endpoint if it announces one"""
+    text = get_text(r)
+    profile = sites.find(urlsplit(r.url).hostname or '')
+    if profile is not None:
+        meta = profile.extract(text)
+        meta['title'] = sanitize(meta['title'])
+        if meta['title'] is not None:
+            stats.incr('site_profile_hits')
+            meta['description'] = sanitize(meta['description'])
+            meta['profiled'] = True
+            return meta
+        stats.incr('site_profile_misses')
+    meta = get_meta(text)
+    oembed.learn(r.url, meta['oembed'])
+    return meta
+
+
+def is_complete(meta):
+    """Returns True if there's no point in trying other user agents"""
+    if meta['title'] is None:
+        return False
+    # The profile knows when a site has no description
+    return meta['description'] is not None or meta.get('profiled', False)
+
+
 def get_meta(content):
     soup = BeautifulSoup(content, 'html.parser')
     ld_json = soup.find('script', {'type': 'application/ld+json'})
@@ -181,11 +536,13 @@ def get_meta(content):
     title = get_title(ld_json, soup)
     description = get_description(ld_json, soup)
     date = get_date(ld_json, soup)
+    link = soup.find('link', {'type': 'application/json+oembed'})
 
     return {
         'title': sanitize(title),
         'description': sanitize(description),
         'date': date,
+        'oembed': link.get('href') if link is not None else None,
     }
 
 
@@ -242,16 +599,16 @@ def get_date(ld_json, soup):
     ]:
         if place is not None:
             try:
-                return parse(place['content'])
-            except ParserError:
+                return dates.parse(place['content'])
+            except ValueError:
                 pass
     # Get date from json
     for prop in ['datePublished', 'dateCreated', 'dateModified', ]:
         if ld_json is not None and prop in ld_json \
                       and ld_json[prop] is not None:
             try:
-                return parse(ld_json[prop])
-            except ParserError:
+                return dates.parse(ld_json[prop])
+            except ValueError:
                 pass
 
     return None
@@ -270,28 +627,46 @@ def sanitize(string):
     return string
 
 
-def format_msg(secure, meta):
-    title = meta['title']
-    description = meta['description']
-    date = meta['date']
-    if title is None:
-        return
+def make_preview(secure, meta):
+    if meta['title'] is None:
+        return None
+    return Preview(
+        'page',
+        title=meta['title'],
+        description=meta['description'],
+        author=meta.get('author'),
+        published=meta['date'],
+        flags=0 if secure else Preview.INSECURE,
+    )
+
+
+def format_msg(preview, options):
+    title = preview.title
+    description = preview.description
+    date = preview.published
+    title_length = options['title_length']
+    description_length = options['description_length']
     msg = 'Preview: '
-    if not secure:
+    if preview.has(Preview.INSECURE):
         # Color codes: 98,52: White on Red background
         msg += '⚠️ \x02\x0398,52Insecure\x0f '
-    msg += '\x02%s\x02' % title[:MAX_TITLE_LENGTH]
-    if len(title) > MAX_TITLE_LENGTH:
+    msg += '\x02%s\x02' % title[:title_length]
+    if len(title) > title_length:
         msg += '…'
     if description is not None:
-        msg += ' ' + description[:MAX_DESCRIPTION_LENGTH]
-        if len(description) > MAX_DESCRIPTION_LENGTH:
+        msg += ' ' + description[:description_length]
+        if len(description) > description_length:
             msg += '…'
+    elif preview.author is not None:
+        msg += ' by %s' % preview.author
     if date is not None:
         msg += ' (%s)' % humanize_time(date)
     return msg
 
 
+register_formatter('page', format_msg)
+
+
 def humanize_time(date):
     if date.utcoffset() is not None:
         date = date - date.utcoffset()
@@ -30,8 +30,6 @@
 
 import regex as re
 
-from .generic import handle
-
 try:
     from supybot.i18n import PluginInternationalization
     _ = PluginInternationalization('URLpreview')
@@ -53,13 +51,9 @@ class NprPreviewer(Previewer):
         if re.search(r'text.npr.org', url) is None:
             story_id = re.match(r'.*npr\.org.*/\d\d\d\d/\d\d/\d\d/(\d+)', url)
             url = 'https://text.npr.org/%s' % story_id.group(1)
-        return handle(url)
+        # Through the plugin, to get the current version after reloads
+        return plugin.previewers.get_generic().handle(url)
 
     def configure(self, plugin, advanced):
         '''Called by config.py during the initial configure step'''
         pass
-
-    def register_vars(self, plugin):
-        '''Called by config.py when the plugin is loaded.
-            Register your variables here.'''
-        pass
@@ -28,13 +28,11 @@
 #
 ###
 
-
-from datetime import datetime
+from datetime import datetime, timezone
 
 import regex as re
-import requests
 
-from supybot import conf, log, registry
+from supybot import log
 from supybot.questions import something, yn
 
 try:
@@ -44,6 +42,9 @@ except ImportError:
     def _(x):
         return x
 
+from URLpreview import api, dates
+from URLpreview.cache import EntityCache
+from URLpreview.preview import Preview, register_formatter
 from URLpreview.previewer import Previewer
 
 # Optional support for humanize
@@ -53,7 +54,19 @@ except ImportError:
     def naturaltime(x):
         return x
 
-TIMEOUT = 10
+
+CACHE_SIZE = 512              # Number of tweets and of users to remember
+MIN_TWEET_TTL = 60            # Tweets are cached for a tenth of their age,
+MAX_TWEET_TTL = 24 * 60 * 60  # within these bounds (in seconds)
+PROFILE_TTL = 24 * 60 * 60    # Seconds to cache profiles
+COUNTERS_TTL = 10 * 60        # Seconds until profile counters are refreshed
+BATCH_SIZE = 100              # Max. users per API request
+
+tweet_cache = EntityCache('twitter_tweets', max_entries=CACHE_SIZE)
+user_cache = EntityCache('twitter_users', max_entries=CACHE_SIZE,
+                         ttl=PROFILE_TTL, counters_ttl=COUNTERS_TTL,
+                         batch_size=BATCH_SIZE)
+PERSISTENT = ('tweet_cache', 'user_cache')  # Carried over on reload
 
 
 class TwitterPreview(Previewer):
@@ -71,7 +84,10 @@ class TwitterPreview(Previewer):
         status_pattern = re.compile(r'twitter.com/\w+/status/(\d+)(?!.*/\w+)')
         status_id = status_pattern.search(url)
         if status_id is not None:
-            preview = get_status(status_id.group(1), token)
+            preview = tweet_cache.get_preview(
+                status_id.group(1),
+                lambda tweet_id: get_status(tweet_id, token),
+                get_ttl=get_tweet_ttl)
             if preview is None:
                 return None
             return preview
@@ -81,23 +97,16 @@ class TwitterPreview(Previewer):
         profile_pattern = re.compile(r'twitter.com/(\w+)(?!.*/\w+)')
         handle = profile_pattern.search(url)
         if handle is not None:
-            profile_info = get_profile(handle.group(1), token)
+            # Usernames are case-insensitive
+            profile_info = user_cache.get_preview(
+                handle.group(1).lower(),
+                lambda user: get_profile(user, token),
+                lambda users: get_profile_counters(users, token))
             if profile_info is None:
                 return None
             return profile_info
         return None
 
-    def register_vars(self, plugin):
-        conf.registerGlobalValue(
-            plugin, 'twitter_enabled',
-            registry.Boolean(False,
-                             _('Enable for Twitter links? (needs API key)')))
-        conf.registerGlobalValue(
-            plugin, 'twitter_api_token',
-            registry.String('',
-                            _('Twitter API OAuth 2.0 Bearer token'),
-                            private=True,))
-
     def configure(self, plugin, advanced):
         if yn(_('Enable for Twitter links? (needs API key)')):
             plugin.twitter_enabled.setValue(True)
@@ -130,12 +139,60 @@ def humanize_count(count):
     return count
 
 
-def humanize_time(timestamp):
+def humanize_time(created_at):
     '''Humanizes time. Doesn't do much if humanize couldn't be imported'''
-    # Remove trailing Z that datetime doesn't like
-    timestamp = timestamp.replace('Z', '')
-    created_at = datetime.fromisoformat(timestamp)
-    return naturaltime(created_at)
+    # Twitter timestamps are in UTC, naturaltime() wants a naive datetime
+    return naturaltime(created_at.replace(tzinfo=None))
+
+
+def format_profile(preview, options):
+    author = format_author(preview.author, preview.username,
+                           preview.has(Preview.VERIFIED))
+    tweet_count = humanize_count(preview.counters['tweets'])
+    followers_count = humanize_count(preview.counters['followers'])
+    return '%s: %s (%s tweets, %s followers)' \
+           % (author, preview.description, tweet_count, followers_count)
+
+
+def format_status(preview, options):
+    author = format_author(preview.author, preview.username,
+                           preview.has(Preview.VERIFIED))
+    time = humanize_time(preview.published)
+    return '%s: %s (%s)' % (author, preview.description, time)
+
+
+register_formatter('profile', format_profile)
+register_formatter('tweet', format_status)
+
+
+def get_tweet_ttl(preview):
+    """Old tweets are less likely to be deleted, so are cached longer"""
+    age = (datetime.now(timezone.utc) - preview.published).total_seconds()
+    return max(MIN_TWEET_TTL, min(MAX_TWEET_TTL, age / 10))
+
+
+def get_profile_counters(users, token):
+    """Returns {username: counters} for the lowercase <users>, in one API
+    request"""
+    headers = {'Authorization': 'Bearer %s' % token}
+    url = 'https://api.twitter.com/2/users/by?usernames=' + ','.join(users)
+    url += '&user.fields=public_metrics'
+    r = api.get(url, headers=headers)
+    if r.status_code != 200:
+        log.error('twitter.get_profile_counters: call to API ' +
+                  'unsuccesful, HTTP status code ' + str(r.status_code))
+        return {}
+    counters = {}
+    for user in r.json().get('data', []):
+        try:
+            metrics = user['public_metrics']
+            counters[user['username'].lower()] = {
+                'tweets': metrics['tweet_count'],
+                'followers': metrics['followers_count'],
+            }
+        except KeyError as e:
+            log.error('twitter.get_profile_counters: %s' % repr(e))
+    return counters
 
 
 def get_profile(user, token):
@@ -144,7 +201,7 @@ def get_profile(user, token):
     # urlencodes commas – so we build the URL by hand
     url = 'https://api.twitter.com/2/users/by/username/' + user
     url += '?user.fields=description,public_metrics,verified'
-    r = requests.get(url, headers=headers, timeout=TIMEOUT)
+    r = api.get(url, headers=headers)
     if r.status_code != 200:
         log.error('twitter.get_profile: call to API ' +
                   'unsuccesful, HTTP status code ' + str(r.status_code))
@@ -167,11 +224,14 @@ def get_profile(user, token):
     description = re.sub('\n+', ' ⏎ ', description)
     # Remove excess whitespace
     description = re.sub(' +', ' ', description)
-    author = format_author(name, username, verified)
-    followers_count = humanize_count(followers_count)
-    tweet_count = humanize_count(tweet_count)
-    return '%s: %s (%s tweets, %s followers)' \
-           % (author, description, tweet_count, followers_count)
+    return Preview(
+        'profile',
+        description=description,
+        author=name,
+        username=username,
+        counters={'tweets': tweet_count, 'followers': followers_count},
+        flags=Preview.VERIFIED if verified else 0,
+    )
 
 
 def get_status(tweet_id, token):
@@ -181,7 +241,7 @@ def get_status(tweet_id, token):
     url = 'https://api.twitter.com/2/tweets/%s' % tweet_id
     url += '?tweet.fields=created_at'
     url += '&expansions=author_id&user.fields=username,verified'
-    r = requests.get(url, headers=headers, timeout=TIMEOUT)
+    r = api.get(url, headers=headers)
     if r.status_code != 200:
         log.error('twitter.get_status: call to API ' +
                   'unsuccesful, HTTP status code ' + str(r.status_code))
@@ -203,6 +263,11 @@ def get_status(tweet_id, token):
     tweet = re.sub('\n+', ' ⏎ ', tweet)
     # Remove excess whitespace
     tweet = re.sub(' +', ' ', tweet)
-    author = format_author(name, username, verified)
-    time = humanize_time(timestamp)
-    return '%s: %s (%s)' % (author, tweet, time)
+    return Preview(
+        'tweet',
+        description=tweet,
+        author=name,
+        username=username,
+        published=dates.parse(timestamp),
+        flags=Preview.VERIFIED if verified else 0,
+    )
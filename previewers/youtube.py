@@ -28,11 +28,10 @@
 #
 ###
 
-from dateutil.parser import parse, ParserError
+from datetime import datetime, timezone
 from enum import Enum
 import random
 import regex as re
-import requests
 
 # Optional support for humanize
 try:
@@ -42,7 +41,7 @@ except ImportError:
         return x
     naturaltime = intcomma = nop
 
-from supybot import conf, log, registry
+from supybot import log
 from supybot.questions import something, yn
 
 try:
@@ -52,11 +51,25 @@ except ImportError:
     def _(x):
         return x
 
+from URLpreview import api, dates
+from URLpreview.cache import EntityCache
+from URLpreview.preview import Preview, register_formatter
 from URLpreview.previewer import Previewer
 
 API_URL = 'https://www.googleapis.com/youtube/v3/videos'
 # https://developers.google.com/youtube/v3/docs/videos/list
-TIMEOUT = 10
+
+CACHE_SIZE = 512              # Number of videos to remember
+LIVE_TTL = 60                 # Seconds to cache live streams,
+UPCOMING_MAX_TTL = 60 * 60    # upcoming ones (at most until they start)
+NORMAL_TTL = 24 * 60 * 60     # and all other videos
+COUNTERS_TTL = 10 * 60        # Seconds until views and likes are refreshed
+BATCH_SIZE = 50               # Max. videos per API request
+
+video_cache = EntityCache('youtube_videos', max_entries=CACHE_SIZE,
+                          ttl=NORMAL_TTL, counters_ttl=COUNTERS_TTL,
+                          batch_size=BATCH_SIZE)
+PERSISTENT = ('video_cache',)  # Carried over on reload, see previewer.py
 
 
 class YoutubePreviewer(Previewer):
@@ -86,19 +99,6 @@ class YoutubePreviewer(Previewer):
             token = something(_('Enter Google Simple API key'))
             plugin.youtube_api_token.setValue(token)
 
-    def register_vars(self, plugin):
-        '''Called by config.py when the plugin is loaded.
-            Register your variables here.'''
-        conf.registerGlobalValue(
-            plugin, 'youtube_enabled',
-            registry.Boolean(False,
-                             _('Enable for YouTube links? (needs API key)')))
-        conf.registerGlobalValue(
-            plugin, 'youtube_api_token',
-            registry.String('',
-                            _('Google Simple API key'),
-                            private=True,))
-
 
 def find_video_id(url):
     """Returns the video id in url or None if none has been found"""
@@ -110,9 +110,59 @@ def find_video_id(url):
 
 
 def preview_video(token, video_id):
+    return video_cache.get_preview(
+        video_id,
+        lambda video_id: fetch_video(token, video_id),
+        lambda video_ids: fetch_counters(token, video_ids),
+        get_ttl)
+
+
+def get_ttl(preview):
+    """Returns how long to cache the preview of a video"""
+    if preview.has(Preview.LIVE):
+        return LIVE_TTL
+    if preview.has(Preview.UPCOMING):
+        start = preview.published
+        if not isinstance(start, datetime):
+            return LIVE_TTL
+        if start.tzinfo is None:
+            start = start.replace(tzinfo=timezone.utc)
+        until_start = (start - datetime.now(timezone.utc)).total_seconds()
+        return max(LIVE_TTL, min(UPCOMING_MAX_TTL, until_start))
+    return NORMAL_TTL
+
+
+def fetch_counters(token, video_ids):
+    """Returns {video id: counters} for <video_ids>, in one API request"""
+    url = '%s?key=%s&id=%s&part=id,statistics' % \
+        (API_URL, token, ','.join(video_ids))
+    r = api.get(url)
+    if r.status_code != 200:
+        log.error('youtube.fetch_counters: call to API ' +
+                  'unsuccesful, HTTP status code ' + str(r.status_code))
+        return {}
+    counters = {}
+    for item in r.json().get('items', []):
+        try:
+            counters[item['id']] = get_counters(item['statistics'])
+        except (KeyError, ValueError) as e:
+            log.error('youtube.fetch_counters:  %s' % repr(e))
+    return counters
+
+
+def get_counters(statistics):
+    counters = {'views': int(statistics['viewCount'])}
+    # Likes and dislikes can be hidden so might not be present
+    if 'likeCount' in statistics and 'dislikeCount' in statistics:
+        counters['likes'] = int(statistics['likeCount'])
+        counters['dislikes'] = int(statistics['dislikeCount'])
+    return counters
+
+
+def fetch_video(token, video_id):
     url = '%s?key=%s&id=%s&part=id,snippet,statistics,liveStreamingDetails' % \
         (API_URL, token, video_id)
-    r = requests.get(url, timeout=TIMEOUT)
+    r = api.get(url)
     if r.status_code != 200:
         log.error('youtube.preview_video: call to API ' +
                   'unsuccesful, HTTP status code ' + str(r.status_code))
@@ -131,7 +181,7 @@ def preview_video(token, video_id):
     meta = get_video_metadata(json)
     if meta is None:
         return None
-    return format_video(meta)
+    return make_preview(meta)
 
 
 class VideoState(Enum):
@@ -172,34 +222,57 @@ def get_video_metadata(json):
         log.error('youtube.get_video_metadata:  %s' % repr(e))
     # Convert published timestamp to datetime object
     try:
-        meta['published'] = parse(meta['published'])
-    except ParserError as e:
+        meta['published'] = dates.parse(meta['published'])
+    except ValueError as e:
         log.error('youtube.get_video_metadata:  %s' % repr(e))
     return meta
 
 
-def format_video(meta):
+def make_preview(meta):
+    flags = {
+        VideoState.NORMAL: 0,
+        VideoState.LIVE: Preview.LIVE,
+        VideoState.UPCOMING: Preview.UPCOMING,
+    }[meta['state']]
+    counters = {'views': int(meta['views'])}
+    if 'rating' in meta:
+        counters['likes'], counters['dislikes'] = meta['rating']
+    return Preview(
+        'video',
+        title=meta['title'],
+        author=meta['channel'],
+        published=meta['published'],
+        counters=counters,
+        flags=flags,
+    )
+
+
+def format_video(preview, options):
     def bold(s):
         return '\x02%s\x02' % s
 
-    title = meta['title']
-    channel = meta['channel']
-    views = intcomma(meta['views'])
-    if 'rating' in meta:
-        rating = 'Rating: %s ' % bold(format_rating(meta['rating']))
+    title = preview.title
+    channel = preview.author
+    views = intcomma(preview.counters['views'])
+    if 'likes' in preview.counters:
+        rating = (preview.counters['likes'], preview.counters['dislikes'])
+        rating = 'Rating: %s ' % bold(format_rating(rating))
     else:
         rating = ''
-    if meta['state'] == VideoState.UPCOMING:
-        when = 'upcoming: %s' % humanize_time(meta['published'])
+    if preview.has(Preview.UPCOMING):
+        when = 'upcoming: %s' % humanize_time(preview.published)
         return '%s: %s (%s)' % (channel, bold(title), when)
-    elif meta['state'] == VideoState.LIVE:
+    elif preview.has(Preview.LIVE):
         when = '🔴 LIVE'
     else:
-        when = humanize_time(meta['published'])
+        when = humanize_time(preview.published)
     return '%s: %s Views: %s %s(%s)' % \
         (channel, bold(title), bold(views), rating, when)
 
 
+register_formatter('video', format_video)
+
+
 def format_rating(rating):
     likes, dislikes = rating
     if likes + dislikes == 0:
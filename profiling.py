@@ -0,0 +1,209 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Profiles of slow previews
+
+While a preview is made, a sampler thread looks at the stack of the thread
+making it every SAMPLE_INTERVAL seconds. If the preview turns out to be
+slower than the threshold, the samples are kept as its profile, together
+with the peak of traced memory and the top allocations if tracemalloc is
+on. The last MAX_PROFILES profiles are kept; they can be written out as
+folded stacks, which flamegraph.pl and speedscope understand.
+
+Tracing memory is global, so with previews running at the same time, the
+peak may belong to another one.
+"""
+
+from collections import Counter, deque
+from contextlib import contextmanager
+import itertools
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+from supybot import log
+
+from URLpreview import stats
+
+MAX_PROFILES = 20         # Profiles of slow previews to keep
+SAMPLE_INTERVAL = 0.01    # Seconds between stack samples
+MAX_DEPTH = 64            # Frames per sample
+TOP_ALLOCATIONS = 10      # Allocations to keep from the memory snapshot
+
+
+class Profile:
+    __slots__ = ('id', 'url', 'domain', 'previewer', 'started', 'duration',
+                 'samples', 'memory_peak', 'allocations')
+
+    def __init__(self, id, url, domain, previewer):
+        self.id = id
+        self.url = url
+        self.domain = domain
+        self.previewer = previewer
+        self.started = time.time()
+        self.duration = None
+        self.samples = Counter()  # stack (outermost frame first) -> count
+        self.memory_peak = None
+        self.allocations = []
+
+    def __repr__(self):
+        return '<Profile #%d %.1fs %s %s>' % (self.id, self.duration or 0,
+                                              self.previewer, self.url)
+
+    def dump(self, path):
+        """Writes the samples to <path> as folded stacks, with the rest as
+        comments"""
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('# %s\n# domain: %s, previewer: %s\n' %
+                    (self.url, self.domain, self.previewer))
+            f.write('# started: %s, took %.3fs, %d samples\n' %
+                    (time.strftime('%Y-%m-%dT%H:%M:%S',
+                                   time.localtime(self.started)),
+                     self.duration, sum(self.samples.values())))
+            if self.memory_peak is not None:
+                f.write('# traced memory peak: %d bytes\n' % self.memory_peak)
+                for allocation in self.allocations:
+                    f.write('#   %s\n' % allocation)
+            for (stack, count) in self.samples.most_common():
+                f.write('%s %d\n' % (';'.join(stack), count))
+
+
+class Profiler:
+    def __init__(self, size=MAX_PROFILES, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.profiles = deque(maxlen=size)
+        self._ids = itertools.count(1)
+        self._tracked = {}  # thread id -> Profile
+        self._tracing = False  # Did we start tracemalloc?
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._stopped = False
+
+    @contextmanager
+    def track(self, url, domain, previewer, threshold, memory=False):
+        """Context manager that profiles the preview made in it, and keeps
+        the profile if it takes at least <threshold> seconds (0: never)"""
+        if not threshold:
+            yield None
+            return
+        self._trace_memory(memory)
+        profile = Profile(next(self._ids), url, domain, previewer)
+        thread_id = threading.get_ident()
+        start = time.perf_counter()
+        with self._lock:
+            self._tracked[thread_id] = profile
+            self._start()
+            self._wakeup.notify()
+        try:
+            yield profile
+        finally:
+            with self._lock:
+                del self._tracked[thread_id]
+            profile.duration = time.perf_counter() - start
+            if profile.duration >= threshold:
+                self._keep(profile)
+
+    def _keep(self, profile):
+        if self._tracing:
+            profile.memory_peak = tracemalloc.get_traced_memory()[1]
+            snapshot = tracemalloc.take_snapshot()
+            profile.allocations = [
+                str(statistic) for statistic in
+                snapshot.statistics('lineno')[:TOP_ALLOCATIONS]]
+        with self._lock:
+            self.profiles.append(profile)
+        stats.incr('slow_previews')
+        log.info('URLpreview: preview of %s took %.1fs, kept as profile #%d'
+                 % (profile.url, profile.duration, profile.id))
+
+    def _trace_memory(self, memory):
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        elif not memory and self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+        if self._tracing:
+            tracemalloc.reset_peak()
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._sample_loop, name='URLpreview profiler',
+                daemon=True)
+            self._thread.start()
+
+    def _sample_loop(self):
+        with self._lock:
+            while not self._stopped:
+                if not self._tracked:
+                    self._wakeup.wait()
+                    continue
+                frames = sys._current_frames()
+                for (thread_id, profile) in self._tracked.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        profile.samples[get_stack(frame)] += 1
+                self._wakeup.wait(self.interval)
+
+    def slowest(self, count=5):
+        """Returns the <count> slowest of the kept profiles"""
+        with self._lock:
+            profiles = list(self.profiles)
+        return sorted(profiles, key=lambda profile: -profile.duration)[:count]
+
+    def get(self, id):
+        with self._lock:
+            for profile in self.profiles:
+                if profile.id == id:
+                    return profile
+        return None
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify()
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+
+def get_stack(frame):
+    """Returns the stack of <frame>, outermost frame first"""
+    stack = []
+    while frame is not None and len(stack) < MAX_DEPTH:
+        code = frame.f_code
+        stack.append('%s (%s:%d)' % (code.co_name,
+                                     os.path.basename(code.co_filename),
+                                     frame.f_lineno))
+        frame = frame.f_back
+    return tuple(reversed(stack))
@@ -0,0 +1,244 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Pool of egress proxies with health checks
+
+Configured by the `proxies` variables. All outgoing requests are sent
+through a proxy from the pool if there is one. Proxies are checked
+periodically and taken out of rotation while they fail or are slower than
+`proxy_max_latency`.
+"""
+
+from contextlib import contextmanager
+import threading
+import time
+from urllib.parse import urlsplit
+
+from supybot import conf, log
+
+from URLpreview import stats
+
+CHECK_INTERVAL = 60   # Seconds between health checks
+CHECK_TIMEOUT = 10
+SMOOTHING = 0.3       # Weight of the newest sample in the average latency
+
+
+class NoProxyAvailable(Exception):
+    """Raised if proxies are configured, but none of them is healthy"""
+
+
+class Proxy:
+    __slots__ = ('url', 'name', 'latency', 'healthy', 'failures')
+
+    def __init__(self, url):
+        self.url = url
+        # Don't show credentials in stats and logs
+        parts = urlsplit(url)
+        self.name = '%s://%s' % (parts.scheme, parts.hostname)
+        if parts.port is not None:
+            self.name += ':%d' % parts.port
+        self.latency = None   # Moving average, in seconds
+        self.healthy = True
+        self.failures = 0
+
+    def as_requests_arg(self):
+        return {'http': self.url, 'https': self.url}
+
+
+class ProxyPool:
+    def __init__(self):
+        self.proxies = []
+        self.selection = 'round-robin'
+        self.max_latency = 5.0
+        self.check_url = None
+        self._next = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()  # Stops the current check thread
+        self._thread = None
+
+    def configure(self, urls, selection, max_latency, check_url):
+        """Updates the pool, keeping the state of proxies that stay"""
+        with self._lock:
+            old = {proxy.url: proxy for proxy in self.proxies}
+            self.proxies = [old.get(url) or Proxy(url) for url in urls]
+            self.selection = selection
+            self.max_latency = max_latency
+            self.check_url = check_url
+        self.start()
+
+    def start(self):
+        """Starts the health checks, unless they are running already"""
+        with self._lock:
+            if not self.proxies or \
+                    self._thread is not None and self._thread.is_alive():
+                return
+            # Each thread gets its own event, so one that is still finishing
+            # a check after stop() can't be restarted by accident
+            self._stop = threading.Event()
+            self._thread = threading.Thread(
+                target=self._check_loop, args=(self._stop,),
+                name='URLpreview proxy checks', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops the health checks and waits (a bit) for them to finish"""
+        with self._lock:
+            self._stop.set()
+            thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(CHECK_TIMEOUT)
+
+    def choose(self):
+        """Returns a healthy proxy, or None if no proxies are configured"""
+        with self._lock:
+            if not self.proxies:
+                return None
+            healthy = [proxy for proxy in self.proxies if proxy.healthy]
+            if not healthy:
+                raise NoProxyAvailable('All %d proxies are unhealthy' %
+                                       len(self.proxies))
+            if self.selection == 'least-latency':
+                # Untested proxies get a chance first
+                return min(healthy, key=lambda proxy: proxy.latency or 0)
+            self._next = (self._next + 1) % len(healthy)
+            return healthy[self._next]
+
+    def report(self, proxy, seconds=None):
+        """Records a request through <proxy> that took <seconds>,
+        or failed if <seconds> is None"""
+        with self._lock:
+            if seconds is None:
+                proxy.failures += 1
+                stats.incr('proxy_failures %s' % proxy.name)
+                if proxy.failures >= 3:
+                    self._eject(proxy, 'failed 3 times in a row')
+                return
+            proxy.failures = 0
+            if proxy.latency is None:
+                proxy.latency = seconds
+            else:
+                proxy.latency += SMOOTHING * (seconds - proxy.latency)
+            stats.record('proxy_latency %s' % proxy.name, seconds)
+            if proxy.latency > self.max_latency:
+                self._eject(proxy, 'too slow (%.1fs)' % proxy.latency)
+
+    def _eject(self, proxy, reason):
+        if proxy.healthy:
+            log.info('URLpreview: taking proxy %s out of rotation: %s' %
+                     (proxy.name, reason))
+            stats.incr('proxy_ejections')
+        proxy.healthy = False
+
+    @contextmanager
+    def request(self):
+        """Context manager around a request, which gets the `proxies`
+        argument for requests and reports how it went"""
+        proxy = self.choose()
+        if proxy is None:
+            yield None
+            return
+        start = time.monotonic()
+        try:
+            yield proxy.as_requests_arg()
+        except Exception as e:
+            # Broken links and blocked hosts aren't the proxy's fault
+            if is_proxy_error(e):
+                self.report(proxy)
+            raise
+        self.report(proxy, time.monotonic() - start)
+
+    def check(self):
+        """Checks every proxy, and returns the unhealthy ones to rotation
+        if they work again"""
+        # Imported here to keep requests off the plugin's load path
+        import requests
+        for proxy in list(self.proxies):
+            start = time.monotonic()
+            try:
+                r = requests.get(self.check_url, timeout=CHECK_TIMEOUT,
+                                 proxies=proxy.as_requests_arg())
+                r.close()
+                ok = r.status_code < 500
+            except Exception as e:
+                log.debug('URLpreview: proxy check for %s failed: %r' %
+                          (proxy.name, e))
+                ok = False
+            seconds = time.monotonic() - start
+            if not ok:
+                stats.incr('proxy_failures %s' % proxy.name)
+                with self._lock:
+                    self._eject(proxy, 'health check failed')
+                continue
+            with self._lock:
+                proxy.failures = 0
+                proxy.latency = seconds if proxy.latency is None else \
+                    proxy.latency + SMOOTHING * (seconds - proxy.latency)
+                if not proxy.healthy and proxy.latency <= self.max_latency:
+                    log.info('URLpreview: proxy %s is back in rotation' %
+                             proxy.name)
+                    proxy.healthy = True
+            stats.record('proxy_latency %s' % proxy.name, seconds)
+
+    def _check_loop(self, stop):
+        while not stop.wait(CHECK_INTERVAL):
+            if not self.proxies:
+                continue
+            self.check()
+
+
+def is_proxy_error(e):
+    """Returns True if the exception <e> means that the proxy failed, rather
+    than the site we tried to reach through it"""
+    import requests
+    if isinstance(e, requests.exceptions.ProxyError):
+        # Raised as well if the proxy couldn't reach the site
+        return 'Tunnel connection failed' not in str(e)
+    # PySocks' error when the SOCKS proxy itself can't be reached
+    return isinstance(e, requests.exceptions.ConnectionError) and \
+        'Error connecting to SOCKS' in str(e)
+
+
+pool = ProxyPool()
+
+
+def configured_pool():
+    """Returns the pool, updated from the plugin's configuration"""
+    group = conf.supybot.plugins.URLpreview
+    urls = group.get('proxies')()
+    settings = (list(urls), group.get('proxy_selection')(),
+                group.get('proxy_max_latency')(),
+                group.get('proxy_check_url')())
+    if settings != (
+            [proxy.url for proxy in pool.proxies], pool.selection,
+            pool.max_latency, pool.check_url):
+        pool.configure(*settings)
+    else:
+        # The checks were stopped if the plugin was unloaded or reloaded
+        pool.start()
+    return pool
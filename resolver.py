@@ -0,0 +1,226 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Caching DNS resolver that refuses to connect to internal addresses
+
+Every host is resolved once per TTL. The addresses are classified at
+that point, and connections made through a session from new_session()
+are pinned to the vetted address, so a second lookup (DNS rebinding)
+can't redirect the bot to a different target.
+"""
+
+import ipaddress
+import socket
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util import connection
+
+# Optional support for dnspython, which gives us the real TTLs
+try:
+    import dns.exception
+    import dns.resolver
+except ImportError:
+    dns = None
+
+from URLpreview import stats, transport
+
+BLOCK_INTERNAL = True  # Refuse to connect to loopback, private etc. addresses
+DEFAULT_TTL = 300      # Used if the TTL is unknown (no dnspython)
+MIN_TTL = 30           # Lower and upper bounds for cached TTLs
+MAX_TTL = 3600
+NEGATIVE_TTL = 30      # How long to remember failed lookups
+MAX_ENTRIES = 4096     # Forget everything when the cache grows beyond this
+
+
+class BlockedAddressError(Exception):
+    """Raised when a host resolves to an address we must not connect to"""
+
+
+class _Entry:
+    __slots__ = ('addresses', 'blocked', 'expires')
+
+    def __init__(self, addresses, blocked, expires):
+        self.addresses = addresses
+        self.blocked = blocked
+        self.expires = expires
+
+
+_lock = threading.Lock()
+_cache = {}
+
+
+def classify(address):
+    """Returns why <address> is considered internal, or None if it's not"""
+    ip = ipaddress.ip_address(address)
+    if getattr(ip, 'ipv4_mapped', None) is not None:
+        ip = ip.ipv4_mapped
+    for (reason, internal) in [
+        ('loopback', ip.is_loopback),
+        ('link-local', ip.is_link_local),
+        ('private', ip.is_private),
+        ('multicast', ip.is_multicast),
+        ('unspecified', ip.is_unspecified),
+        ('reserved', ip.is_reserved),
+    ]:
+        if internal:
+            return reason
+    return None
+
+
+def lookup(host, port=0):
+    """Returns (addresses, ttl) for <host>; raises socket.gaierror"""
+    try:
+        ipaddress.ip_address(host)
+        return [host], MAX_TTL  # Already an address
+    except ValueError:
+        pass
+    if dns is not None:
+        addresses = []
+        ttl = MAX_TTL
+        for rdtype in ['A', 'AAAA']:
+            try:
+                answer = dns.resolver.resolve(host, rdtype)
+            except dns.exception.DNSException:
+                continue
+            addresses += [rdata.address for rdata in answer]
+            ttl = min(ttl, answer.rrset.ttl)
+        if addresses:
+            return addresses, ttl
+        # Fall back to the system resolver, e.g. for /etc/hosts entries
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    addresses = []
+    for (_, _, _, _, sockaddr) in infos:
+        if sockaddr[0] not in addresses:
+            addresses.append(sockaddr[0])
+    return addresses, DEFAULT_TTL
+
+
+def resolve(host, port=0):
+    """Returns the cached, vetted addresses for <host>.
+    Raises BlockedAddressError if the host is internal, socket.gaierror if
+    it can't be resolved."""
+    host = host.rstrip('.').strip('[]').lower()
+    now = time.monotonic()
+    with _lock:
+        entry = _cache.get(host)
+    if entry is not None and entry.expires > now:
+        stats.incr('dns_cache_hits')
+    else:
+        stats.incr('dns_cache_misses')
+        try:
+            addresses, ttl = lookup(host, port)
+        except socket.gaierror as e:
+            addresses, ttl = [], NEGATIVE_TTL
+            blocked = repr(e)
+        else:
+            ttl = min(max(ttl, MIN_TTL), MAX_TTL)
+            # A single internal address spoils the whole host
+            blocked = None
+            for address in addresses:
+                blocked = classify(address)
+                if blocked is not None:
+                    blocked = '%s resolves to %s address %s' % \
+                        (host, blocked, address)
+                    break
+        entry = _Entry(addresses, blocked, now + ttl)
+        with _lock:
+            if len(_cache) >= MAX_ENTRIES:
+                _cache.clear()
+            _cache[host] = entry
+    if not entry.addresses:
+        raise socket.gaierror(entry.blocked)
+    if entry.blocked is not None and BLOCK_INTERNAL:
+        stats.incr('blocked_hosts')
+        raise BlockedAddressError(entry.blocked)
+    return entry.addresses
+
+
+def clear():
+    with _lock:
+        _cache.clear()
+
+
+class _PinnedConnectionMixin:
+    """Connects to an address from resolve() instead of doing its own DNS
+    lookup. Host header, SNI and certificate checks still use the name."""
+
+    def _new_conn(self):
+        addresses = resolve(self._dns_host, self.port)
+        error = None
+        for address in addresses:
+            try:
+                return connection.create_connection(
+                    (address, self.port),
+                    self.timeout,
+                    source_address=self.source_address,
+                    socket_options=self.socket_options,
+                )
+            except socket.timeout:
+                error = ConnectTimeoutError(
+                    self, 'Connection to %s timed out. (connect timeout=%s)'
+                    % (self.host, self.timeout))
+            except OSError as e:
+                error = NewConnectionError(
+                    self, 'Failed to establish a new connection: %s' % e)
+        raise error
+
+
+class PinnedHTTPConnection(_PinnedConnectionMixin, HTTPConnection):
+    pass
+
+
+class PinnedHTTPSConnection(_PinnedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class PinnedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = PinnedHTTPConnection
+
+
+class PinnedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = PinnedHTTPSConnection
+
+
+class PinnedAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': PinnedHTTPConnectionPool,
+            'https': PinnedHTTPSConnectionPool,
+        }
+
+
+def new_session():
+    """Returns a requests session that connects through resolve()"""
+    return transport.session(PinnedAdapter())
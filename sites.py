@@ -0,0 +1,207 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Per-site extraction profiles for the generic previewer
+
+For sites whose pages we know, a profile says where the good data is:
+which <meta> tags (property:… or name:…), JSON-LD properties (ld:…, with
+dots for nested ones) or the <title> to read, in order of preference, and
+whether everything needed is in the <head>. Profiles are compiled when
+this module is loaded; pages from these sites are then parsed only as far
+as needed, and the full generic cascade is skipped.
+
+A profile applies to its domain and all subdomains. If it doesn't find a
+title, the page goes through the generic cascade after all.
+"""
+
+import json
+
+from bs4 import BeautifulSoup, SoupStrainer
+import regex as re
+
+from URLpreview import dates
+
+PROFILES = {
+    'bbc.co.uk': {
+        'title': ['property:og:title'],
+        'description': ['property:og:description'],
+        'date': ['ld:datePublished'],
+    },
+    'github.com': {
+        'title': ['property:og:title'],
+        'description': ['property:og:description'],
+        'head_only': True,
+    },
+    'heise.de': {
+        'title': ['property:og:title'],
+        'description': ['property:og:description'],
+        'date': ['name:date'],
+        'head_only': True,
+    },
+    'nytimes.com': {
+        'title': ['property:og:title'],
+        'description': ['property:og:description'],
+        'date': ['property:article:published_time'],
+        'head_only': True,
+    },
+    'spiegel.de': {
+        'title': ['property:og:title'],
+        'description': ['property:og:description'],
+        'date': ['name:date'],
+        'head_only': True,
+    },
+    'theguardian.com': {
+        'title': ['property:og:title'],
+        'description': ['property:og:description'],
+        'date': ['property:article:published_time'],
+        'head_only': True,
+    },
+    'wikipedia.org': {
+        'title': ['property:og:title', 'title'],
+        # Articles have no description in their <head>
+        'date': ['ld:dateModified'],
+    },
+}
+
+HEAD_END = re.compile(r'</head\s*>', re.I)
+
+
+class SiteProfile:
+    __slots__ = ('domain', 'title', 'description', 'date', 'head_only',
+                 'strainer', 'uses_ld')
+
+    def __init__(self, domain, title=(), description=(), date=(),
+                 head_only=False):
+        self.domain = domain
+        self.title = [compile_source(source) for source in title]
+        self.description = [compile_source(source) for source in description]
+        self.date = [compile_source(source) for source in date]
+        self.head_only = head_only
+        kinds = {kind for (kind, _) in self.title + self.description +
+                 self.date}
+        self.uses_ld = 'ld' in kinds
+        # Only build the parts of the tree we are going to look at
+        tags = []
+        if kinds & {'property', 'name'}:
+            tags.append('meta')
+        if 'title' in kinds:
+            tags.append('title')
+        if self.uses_ld:
+            tags.append('script')
+        self.strainer = SoupStrainer(tags)
+
+    def __repr__(self):
+        return '<SiteProfile %s>' % self.domain
+
+    def extract(self, text):
+        """Returns the title, description and date found in the page <text>
+        (unsanitized)"""
+        if self.head_only:
+            match = HEAD_END.search(text)
+            if match is not None:
+                text = text[:match.start()]
+        soup = BeautifulSoup(text, 'html.parser', parse_only=self.strainer)
+        # Index the <meta> tags once instead of searching for each source
+        values = {}
+        for tag in soup.find_all('meta'):
+            content = tag.get('content')
+            for attribute in ('property', 'name'):
+                key = tag.get(attribute)
+                if key is not None and content is not None:
+                    values.setdefault((attribute, key), content)
+        if soup.title is not None and soup.title.string is not None:
+            values[('title', '')] = soup.title.string
+        if self.uses_ld:
+            for tag in soup.find_all('script',
+                                     {'type': 'application/ld+json'}):
+                try:
+                    values[('ld', '')] = json.loads(tag.string or '')
+                    break
+                except ValueError:
+                    pass
+
+        date = first(self.date, values)
+        if date is not None:
+            try:
+                date = dates.parse(date)
+            except ValueError:
+                date = None
+        return {
+            'title': first(self.title, values),
+            'description': first(self.description, values),
+            'date': date,
+        }
+
+
+def compile_source(source):
+    """Turns 'property:og:title' into ('property', 'og:title') etc."""
+    if source == 'title':
+        return ('title', '')
+    (kind, _, key) = source.partition(':')
+    if kind not in ('property', 'name', 'ld') or not key:
+        raise ValueError('Invalid source %r' % source)
+    if kind == 'ld':
+        return ('ld', tuple(key.split('.')))
+    return (kind, key)
+
+
+def first(sources, values):
+    """Returns the first value found for <sources>, or None"""
+    for (kind, key) in sources:
+        if kind == 'ld':
+            value = get_path(values.get(('ld', '')), key)
+        else:
+            value = values.get((kind, key))
+        if isinstance(value, str) and value.strip():
+            return value
+    return None
+
+
+def get_path(data, path):
+    for key in path:
+        if isinstance(data, list):
+            data = data[0] if data else None
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def find(domain):
+    """Returns the profile for <domain> or one of its parent domains"""
+    while domain:
+        profile = profiles.get(domain)
+        if profile is not None:
+            return profile
+        domain = domain.partition('.')[2]
+    return None
+
+
+profiles = {domain: SiteProfile(domain, **profile)
+            for (domain, profile) in PROFILES.items()}
@@ -0,0 +1,91 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Process-wide counters and timings, reported by the `stats` command"""
+
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+
+
+def incr(name, amount=1):
+    """Adds <amount> to the counter <name>"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def record(name, seconds):
+    """Records a duration for the timing <name>"""
+    with _lock:
+        count, total, maximum = _timings.get(name, (0, 0.0, 0.0))
+        _timings[name] = (count + 1, total + seconds, max(maximum, seconds))
+
+
+def peak(name, value):
+    """Sets the counter <name> to <value> if that's higher than before"""
+    with _lock:
+        if value > _counters.get(name, 0):
+            _counters[name] = value
+
+
+def get(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timings.clear()
+
+
+def summary():
+    """Returns a one-line summary of all counters and timings"""
+    with _lock:
+        counters = sorted(_counters.items())
+        timings = sorted(_timings.items())
+    parts = ['%s: %s' % (name, value) for (name, value) in counters]
+    for (name, (count, total, maximum)) in timings:
+        parts.append('%s: %d× avg %.0fms max %.0fms' %
+                     (name, count, total / count * 1000, maximum * 1000))
+    wire = dict(counters).get('bytes_wire', 0)
+    decoded = dict(counters).get('bytes_decoded', 0)
+    if decoded > 0:
+        parts.append('compression savings: %.0f%%' %
+                     ((1 - wire / decoded) * 100))
+    prefetches = dict(counters).get('prefetches', 0)
+    if prefetches > 0:
+        parts.append('prefetch hit ratio: %.0f%%' %
+                     (dict(counters).get('prefetch_hits', 0) / prefetches
+                      * 100))
+    if not parts:
+        return 'No statistics collected yet.'
+    return ', '.join(parts)
@@ -28,6 +28,13 @@
 
 ###
 
+import http.client
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+from urllib.parse import urlsplit
+
 from supybot.test import *
 
 
@@ -35,4 +42,861 @@ class URLpreviewTestCase(PluginTestCase):
     plugins = ('URLpreview',)
 
 
+class Site(BaseHTTPRequestHandler):
+    """Local web server; serves <routes>: path -> (status, headers, body)"""
+    routes = {}
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        # Routes match with or without the query
+        path = self.path if self.path in self.routes \
+            else self.path.partition('?')[0]
+        (status, headers, body) = self.routes.get(
+            path, (404, {}, b'<title>Not found</title>'))
+        headers = dict({'Content-Type': 'text/html; charset=utf-8'},
+                       **headers)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInProxy(BaseHTTPRequestHandler):
+    """Forward proxy that sends requests for the names in <hosts> to local
+    servers, and remembers the URLs it was asked for"""
+    hosts = {}     # name -> (address, port)
+    requested = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.requested.append(self.path)
+        url = urlsplit(self.path)
+        if url.hostname not in self.hosts:
+            self.send_error(502)
+            return
+        connection = http.client.HTTPConnection(*self.hosts[url.hostname],
+                                                timeout=5)
+        connection.request('GET', url.path or '/')
+        response = connection.getresponse()
+        body = response.read()
+        self.send_response(response.status)
+        for (name, value) in response.getheaders():
+            if name.lower() not in ('connection', 'transfer-encoding'):
+                self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        connection.close()
+
+    def do_CONNECT(self):
+        self.requested.append(self.path)
+        self.send_error(502)  # No tunnels, and no TLS sites to reach
+
+
+def start_server(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class CanonicalTestCase(SupyTestCase):
+    CASES = [
+        # youtube
+        ('https://youtu.be/dQw4w9WgXcQ?t=30',
+         'https://www.youtube.com/watch?v=dQw4w9WgXcQ'),
+        ('https://m.youtube.com/watch?feature=share&v=dQw4w9WgXcQ&t=30s',
+         'https://www.youtube.com/watch?v=dQw4w9WgXcQ'),
+        ('https://www.youtube.com/shorts/abc-_1',
+         'https://www.youtube.com/watch?v=abc-_1'),
+        ('https://youtube.com/live/abc',
+         'https://www.youtube.com/watch?v=abc'),
+        # twitter
+        ('https://mobile.twitter.com/jack/status/20?s=20&ref_src=twsrc',
+         'https://twitter.com/jack/status/20'),
+        ('https://twitter.com/jack', 'https://twitter.com/jack'),
+        # tracking parameters
+        ('https://example.com/a?utm_source=x&id=1&fbclid=y&UTM_Medium=z',
+         'https://example.com/a?id=1'),
+        ('https://example.com/a?utm_source=x', 'https://example.com/a'),
+        # default ports and fragments
+        ('HTTPS://EXAMPLE.com:443/path#frag', 'https://example.com/path'),
+        ('http://example.com:80', 'http://example.com/'),
+        ('http://example.com:8080/', 'http://example.com:8080/'),
+        ('http://[::1]:8080/', 'http://[::1]:8080/'),
+        # userinfo is kept as it was written
+        ('https://User:pw@Example.com/', 'https://User:pw@example.com/'),
+        # unparsable URLs are left alone
+        ('http://[::1/', 'http://[::1/'),
+        ('http://[::1]:99999/', 'http://[::1]:99999/'),
+        # percent-encoding is neither decoded nor normalized
+        ('https://example.com/caf%C3%A9/a%2Fb?q=%41',
+         'https://example.com/caf%C3%A9/a%2Fb?q=%41'),
+        ('https://example.com/caf%c3%a9', 'https://example.com/caf%c3%a9'),
+    ]
+
+    def testCanonicalize(self):
+        from .canonical import canonicalize
+        for (url, expected) in self.CASES:
+            with self.subTest(url=url):
+                self.assertEqual(canonicalize(url), expected)
+
+
+class DatesTestCase(SupyTestCase):
+    def testFastPaths(self):
+        from dateutil.parser import parse as dateutil_parse
+        from . import dates
+        from .benchmarks.dates import SAMPLES
+        samples = SAMPLES + [
+            '2020-10-01T14:34:56-0530',
+            '2020-10-01T14:34:56,5+02',
+            '2020-10-01T12:34:56z',
+            '01 Oct 2020 12:34 UTC',
+        ]
+        for sample in samples:
+            with self.subTest(sample=sample):
+                fast = dates.parse_iso(sample) or \
+                    dates.parse_rfc2822(sample)
+                expected = dateutil_parse(sample)
+                if sample == 'October 1, 2020':
+                    self.assertIsNone(fast)
+                else:
+                    self.assertEqual(fast, expected)
+                    self.assertEqual(fast.utcoffset(), expected.utcoffset())
+                self.assertEqual(dates.parse(sample), expected)
+
+    def testInvalid(self):
+        from . import dates
+        self.assertRaises(ValueError, dates.parse, '2020-13-01')
+        self.assertRaises(ValueError, dates.parse, 'not a date')
+
+
+class ResolverTestCase(SupyTestCase):
+    """resolver.py is what keeps the bot from fetching internal URLs"""
+
+    def setUp(self):
+        super().setUp()
+        from . import resolver
+        self.resolver = resolver
+        self.lookup = resolver.lookup
+        resolver.clear()
+
+    def tearDown(self):
+        self.resolver.lookup = self.lookup
+        self.resolver.clear()
+        super().tearDown()
+
+    def testClassify(self):
+        for (address, reason) in [
+            ('127.0.0.1', 'loopback'),
+            ('::1', 'loopback'),
+            ('10.1.2.3', 'private'),
+            ('192.168.0.1', 'private'),
+            ('169.254.169.254', 'link-local'),
+            ('fe80::1', 'link-local'),
+            ('::ffff:127.0.0.1', 'loopback'),
+            ('::ffff:10.0.0.1', 'private'),
+            ('93.184.216.34', None),
+            ('2606:2800:220:1:248:1893:25c8:1946', None),
+        ]:
+            self.assertEqual(self.resolver.classify(address), reason,
+                             address)
+
+    def testResolve(self):
+        for host in ['127.0.0.1', '[::1]', '169.254.169.254', 'localhost',
+                     '::ffff:192.168.1.1']:
+            with self.assertRaises(self.resolver.BlockedAddressError,
+                                   msg=host):
+                self.resolver.resolve(host)
+        self.assertEqual(self.resolver.resolve('93.184.216.34'),
+                         ['93.184.216.34'])
+
+    def testNegativeCache(self):
+        import socket
+        lookups = []
+
+        def lookup(host, port=0):
+            lookups.append(host)
+            raise socket.gaierror('no such host')
+        self.resolver.lookup = lookup
+        for _ in range(3):
+            with self.assertRaises(socket.gaierror):
+                self.resolver.resolve('nonexistent.test')
+        self.assertEqual(lookups, ['nonexistent.test'])
+
+    def testRedirectToInternal(self):
+        site = start_server(Site)
+        port = site.server_address[1]
+        Site.routes = {
+            '/page': (200, {}, b'<title>Public</title>'),
+            '/redirect': (302, {
+                'Location': 'http://127.0.0.1:%d/page' % port}, b''),
+        }
+        # A public name for the local server, as if resolve() had vetted it
+        self.resolver._cache['public.test'] = self.resolver._Entry(
+            ['127.0.0.1'], None, float('inf'))
+        session = self.resolver.new_session()
+        try:
+            r = session.get('http://public.test:%d/page' % port, timeout=5)
+            self.assertEqual(r.status_code, 200)
+            # The pinned connection vets the target of the redirect as well
+            with self.assertRaises(self.resolver.BlockedAddressError):
+                session.get('http://public.test:%d/redirect' % port,
+                            timeout=5)
+        finally:
+            session.close()
+            site.shutdown()
+            site.server_close()
+
+
+class ReloadTestCase(SupyTestCase):
+    def testOldCollection(self):
+        from . import previewer
+        old = previewer.PreviewerCollection()
+        generic = old.get_generic()
+        # Like reloading the plugin
+        previewer._current.clear()
+        new = previewer.PreviewerCollection()
+        self.assertIsNot(new.get_generic(), generic)
+        # Previews running on the old collection keep the old code
+        self.assertIs(old.get_generic(), generic)
+        self.assertIs(new.get_generic().preview_cache, generic.preview_cache)
+
+
+class EntityCacheTestCase(SupyTestCase):
+    def setUp(self):
+        super().setUp()
+        from .cache import EntityCache
+        from .preview import Preview
+        self.cache = EntityCache('test', counters_ttl=600)
+        self.cache.get_preview(
+            'a', lambda key: Preview('video', title=key,
+                                     counters={'views': 1}))
+        self.calls = 0
+
+    def get(self, fetch_counters):
+        def counted(keys):
+            self.calls += 1
+            return fetch_counters(keys)
+        return self.cache.get_preview('a', None, counted)
+
+    def testRefresh(self):
+        self.cache.get('a').counters_expire = 0
+        self.assertEqual(self.get(lambda keys: {'a': {'views': 2}})
+                         .counters, {'views': 2})
+        self.assertEqual(self.get(lambda keys: {}).counters, {'views': 2})
+        self.assertEqual(self.calls, 1)
+
+    def testFailedRefresh(self):
+        def fail(keys):
+            raise TimeoutError()
+        for fetch_counters in (fail, lambda keys: {}):
+            self.cache.get('a').counters_expire = 0
+            for _ in range(3):
+                preview = self.get(fetch_counters)
+                self.assertEqual(preview.title, 'a')
+                self.assertEqual(preview.counters, {'views': 1})
+        # Failures back off until the next refresh is due, like successes
+        self.assertEqual(self.calls, 2)
+
+
+class GovernorTestCase(SupyTestCase):
+    def testRoundRobin(self):
+        from .governor import Governor, GovernorTimeout
+        governor = Governor(max_connections=1, per_host=1, timeout=0.75)
+        served, timeouts = [], []
+
+        def download(name, host):
+            try:
+                with governor.connection(host):
+                    served.append(name)
+                    time.sleep(0.3)
+            except GovernorTimeout:
+                timeouts.append(name)
+
+        threads = []
+        for (name, host) in [('first', 'a'), ('a1', 'a'), ('a2', 'a'),
+                             ('a3', 'a'), ('a4', 'a'), ('a5', 'a'),
+                             ('b', 'b')]:
+            thread = threading.Thread(target=download, args=(name, host))
+            thread.start()
+            threads.append(thread)
+            # Queue them up in this order, behind the first one
+            while len(served) + sum(map(len, governor._waiting.values())) \
+                    < len(threads):
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+        # b doesn't wait behind all of a
+        self.assertEqual(served, ['first', 'a1', 'b'])
+        self.assertEqual(sorted(timeouts), ['a2', 'a3', 'a4', 'a5'])
+        self.assertEqual(governor._waiting, {})
+        self.assertEqual(governor._active, {})
+
+    def testBandwidth(self):
+        from .governor import Governor
+        governor = Governor(bytes_per_second=1000)
+        start = time.monotonic()
+        governor.throttle(1000)  # Within the budget
+        self.assertLess(time.monotonic() - start, 0.1)
+        governor.throttle(500)
+        self.assertGreater(time.monotonic() - start, 0.4)
+
+
+class GenericTestCase(SupyTestCase):
+    """The generic previewer with a local web server"""
+
+    def setUp(self):
+        super().setUp()
+        from . import resolver
+        from .previewers import generic
+        self.resolver, self.generic = resolver, generic
+        resolver.BLOCK_INTERNAL = False
+        self.site = start_server(Site)
+        self.url = 'http://127.0.0.1:%d' % self.site.server_address[1]
+        Site.routes = {
+            '/article': (200, {}, b'<title>Article</title>'
+                                  b'<meta name="description" content="Hi">'),
+        }
+        generic.preview_cache.clear()
+        generic.redirect_cache.clear()
+
+    def tearDown(self):
+        self.resolver.BLOCK_INTERNAL = True
+        self.site.shutdown()
+        self.site.server_close()
+        super().tearDown()
+
+    def testTemporaryRedirect(self):
+        import time
+        Site.routes['/short'] = (302, {'Location': '/article'}, b'')
+        short = self.url + '/short'
+        for _ in range(2):
+            self.assertEqual(self.generic.handle(short).title, 'Article')
+            entry = self.generic.redirect_cache.get(short)
+            self.assertEqual(entry.value, (self.url + '/article', 1))
+            self.assertLessEqual(
+                entry.expires,
+                time.monotonic() + self.generic.TEMPORARY_REDIRECT_TTL)
+            # The second time, the article is fetched directly
+            self.generic.preview_cache.clear()
+
+    def testNonASCII(self):
+        from . import stats
+        Site.routes['/M%C3%BCller'] = (200, {},
+                                       '<title>Müller</title>'.encode())
+        url = self.url + '/Müller'
+        self.assertEqual(self.generic.handle(url).title, 'Müller')
+        hits = stats.get('cache_hits')
+        self.assertEqual(self.generic.handle(url).title, 'Müller')
+        self.assertEqual(stats.get('cache_hits'), hits + 1)
+
+    def testCharsets(self):
+        from . import stats
+        title = 'Café naïve, résumé'
+        # Complete, so that it isn't fetched again with another user agent
+        html = '<title>%s</title><meta name="description" content="Hi">'
+        Site.routes.update({
+            # Only the <meta> tag tells
+            '/meta': (200, {'Content-Type': 'text/html'}, (
+                '<meta charset="iso-8859-1">' + html % title)
+                .encode('latin-1')),
+            # The header wins over the <meta> tag
+            '/header': (200, {'Content-Type': 'text/html; charset=latin-1'},
+                        ('<meta charset="utf-8">' + html % title)
+                        .encode('latin-1')),
+            '/bom': (200, {'Content-Type': 'text/html'},
+                     (html % title).encode('utf-16')),
+            # Nothing tells, and it isn't UTF-8. Detection may well guess a
+            # Central European code page, so only letters common to both.
+            '/undeclared': (200, {'Content-Type': 'text/html'}, (
+                html % 'Schöne Grüße aus Köln').encode('cp1252')),
+        })
+        for (path, source, expected) in [
+            ('/meta', 'charset_meta', title),
+            ('/header', 'charset_header', title),
+            ('/bom', 'charset_bom', title),
+            ('/undeclared', 'charset_detected', 'Schöne Grüße aus Köln'),
+        ]:
+            with self.subTest(path=path):
+                count = stats.get(source)
+                self.assertEqual(self.generic.handle(self.url + path).title,
+                                 expected)
+                self.assertEqual(stats.get(source), count + 1)
+
+    def testOembed(self):
+        from . import oembed, stats
+        oembed.endpoints.clear()
+        link = ('<link rel="alternate" type="application/json+oembed" '
+                'href="%s/oembed?format=json&url=%s/post">' %
+                (self.url, self.url))
+        Site.routes.update({
+            '/post': (200, {}, ('<title>Page</title>' + link).encode()),
+            '/other': (200, {}, b'<title>Page</title>'),
+            '/oembed': (200, {'Content-Type': 'application/json'},
+                        b'{"title": "From oEmbed", "author_name": "Ann"}'),
+        })
+        self.assertEqual(self.generic.handle(self.url + '/post').title,
+                         'Page')
+        self.assertEqual(
+            oembed.endpoint_for(self.url + '/other'),
+            self.url + '/oembed?format=json&url=' +
+            'http%3A%2F%2F127.0.0.1%3A' + self.url.rpartition(':')[2] +
+            '%2Fother')
+        avoided = stats.get('oembed_page_fetches_avoided')
+        preview = self.generic.handle(self.url + '/other')
+        self.assertEqual((preview.title, preview.author),
+                         ('From oEmbed', 'Ann'))
+        self.assertEqual(stats.get('oembed_page_fetches_avoided'),
+                         avoided + 1)
+        # A failing endpoint is forgotten, and the page fetched instead
+        Site.routes['/oembed'] = (404, {}, b'')
+        self.generic.preview_cache.clear()
+        self.assertEqual(self.generic.handle(self.url + '/other').title,
+                         'Page')
+        self.assertIsNone(oembed.endpoint_for(self.url + '/other'))
+
+    def testFailedBackgroundRefresh(self):
+        url = self.url + '/article'
+        self.generic.handle(url)
+        entry = self.generic.preview_cache.get(url)
+        entry.hits = self.generic.HOT_HITS
+        entry.expires = time.monotonic() - 1
+        fetch = self.generic.fetch
+        calls = []
+
+        def fail(*args):
+            calls.append(args)
+            raise OSError('Network is down')
+        self.generic.fetch = fail
+        try:
+            for attempt in (1, 2):
+                # Served stale, and refreshed in the background
+                self.assertEqual(self.generic.handle(url).title, 'Article')
+                deadline = time.monotonic() + 5
+                while (entry.refreshing or len(calls) < attempt) and \
+                        time.monotonic() < deadline:
+                    time.sleep(0.01)
+                # A failed refresh doesn't keep it from being tried again
+                self.assertEqual(len(calls), attempt)
+                self.assertFalse(entry.refreshing)
+        finally:
+            self.generic.fetch = fetch
+
+    def testErrorsNotCached(self):
+        url = self.url + '/article'
+        Site.routes['/article'] = (503, {}, b'<title>Busy</title>')
+        self.assertEqual(self.generic.handle(url).title, 'Error 503')
+        Site.routes['/article'] = (200, {}, b'<title>Article</title>')
+        self.assertEqual(self.generic.handle(url).title, 'Article')
+        # An error doesn't replace the cached page either
+        Site.routes['/article'] = (429, {}, b'<title>Slow down</title>')
+        self.generic.preview_cache.get(url).expires = 0
+        self.assertEqual(self.generic.handle(url).title, 'Article')
+
+
+class RepeatTestCase(ChannelPluginTestCase):
+    plugins = ('URLpreview',)
+
+    def setUp(self):
+        super().setUp()
+        from . import resolver
+        self.resolver = resolver
+        resolver.BLOCK_INTERNAL = False
+        self.site = start_server(Site)
+        self.url = 'http://127.0.0.1:%d/late' % self.site.server_address[1]
+
+    def tearDown(self):
+        self.resolver.BLOCK_INTERNAL = True
+        self.site.shutdown()
+        self.site.server_close()
+        super().tearDown()
+
+    def paste(self, url=None):
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel, url or self.url,
+                                         prefix=self.prefix))
+        return self.irc.takeMsg()
+
+    def testRetryFailed(self):
+        Site.routes = {'/late': (200, {'Content-Type': 'image/png'}, b'')}
+        self.assertIsNone(self.paste())
+        # Not previewed, so it isn't a repeat
+        Site.routes = {'/late': (200, {}, b'<title>Here now</title>')}
+        self.assertIn('Here now', self.paste().args[1])
+        self.assertIsNone(self.paste())
+
+    def testPrefetch(self):
+        from . import stats
+        from .previewers import generic
+        generic.preview_cache.clear()
+        Site.routes = {'/late': (200, {}, b'<title>In the topic</title>')}
+        prefetches = stats.get('prefetches')
+        hits = stats.get('prefetch_hits')
+        with conf.supybot.plugins.URLpreview.prefetch.context(True):
+            self.irc.feedMsg(ircmsgs.topic(
+                self.channel, 'Read this: %s' % self.url,
+                prefix=self.prefix))
+            deadline = time.monotonic() + 5
+            while stats.get('prefetches') == prefetches and \
+                    time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertIsNotNone(generic.preview_cache.get(self.url))
+        # Pasted, it is previewed from the cache
+        Site.routes = {'/late': (200, {}, b'<title>Changed</title>')}
+        self.assertIn('In the topic', self.paste().args[1])
+        self.assertEqual(stats.get('prefetch_hits'), hits + 1)
+
+    def testRateLimit(self):
+        from . import stats
+        Site.routes = {'/%d' % i: (200, {}, b'<title>Page %d</title>' % i)
+                       for i in range(6)}
+        base = self.url.rpartition('/')[0]
+        with conf.supybot.plugins.URLpreview.rate_limit.context(2):
+            limited = stats.get('rate_limited')
+            self.assertIn('Page 0', self.paste(base + '/0').args[1])
+            self.assertIn('Page 1', self.paste(base + '/1').args[1])
+            self.assertIsNone(self.paste(base + '/2'))
+            self.assertEqual(stats.get('rate_limited'), limited + 1)
+        with conf.supybot.plugins.URLpreview.rate_limit.context(0):
+            for i in range(2, 6):
+                self.assertIn('Page %d' % i,
+                              self.paste(base + '/%d' % i).args[1])
+
+
+class DaemonTestCase(ChannelPluginTestCase):
+    plugins = ('URLpreview',)
+
+    def setUp(self):
+        super().setUp()
+        import tempfile
+        from . import daemon, resolver
+        self.daemon, self.resolver = daemon, resolver
+        resolver.BLOCK_INTERNAL = False
+        self.site = start_server(Site)
+        self.url = 'http://127.0.0.1:%d' % self.site.server_address[1]
+        Site.routes = {
+            '/one': (200, {}, b'<title>One</title>'),
+            '/two': (200, {}, b'<title>Two</title>'),
+            '/image': (200, {'Content-Type': 'image/png'}, b''),
+        }
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'daemon.sock')
+        self.server = self.start_daemon()
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        self.directory.cleanup()
+        self.resolver.BLOCK_INTERNAL = True
+        self.site.shutdown()
+        self.site.server_close()
+        super().tearDown()
+
+    def start_daemon(self):
+        server = self.daemon.Server(self.path)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def paste(self, url):
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel, url,
+                                         prefix=self.prefix))
+        return self.irc.takeMsg()
+
+    def testClient(self):
+        client = self.daemon.Client()
+        try:
+            self.assertEqual(
+                client.get_preview(self.path, self.url + '/one',
+                                   {'title_length': 2}),
+                'Preview: \x02On\x02…')
+            self.assertIsNone(
+                client.get_preview(self.path, self.url + '/image', {}))
+        finally:
+            client.close()
+        self.assertEqual(os.stat(self.path).st_mode & 0o777,
+                         self.daemon.SOCKET_MODE)
+
+    def testCoalescing(self):
+        import time
+        daemon = self.daemon.Daemon()
+        calls = []
+
+        def make_preview(url):
+            calls.append(url)
+            time.sleep(0.2)
+            return url.upper()
+        daemon._make_preview = make_preview
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(daemon.get_preview('a')))
+            for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, ['a'])
+        self.assertEqual(results, ['A', 'A', 'A'])
+
+    def testFallback(self):
+        from . import stats
+        import time
+        with conf.supybot.plugins.URLpreview.daemon_socket.context(
+                self.path):
+            previews = stats.get('daemon_previews')
+            self.assertIn('One', self.paste(self.url + '/one').args[1])
+            self.assertEqual(stats.get('daemon_previews'), previews + 1)
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            fallbacks = stats.get('daemon_fallbacks')
+            self.assertIn('Two', self.paste(self.url + '/two').args[1])
+            self.assertEqual(stats.get('daemon_fallbacks'), fallbacks + 1)
+            # Not tried again for a while
+            client = self.irc.getCallback('URLpreview').daemon
+            self.assertGreater(client._down_until, time.monotonic())
+
+    def testBadResponse(self):
+        import socketserver
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.rfile.readline()
+                self.wfile.write(b'["not", "an", "object"]\n')
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = socketserver.UnixStreamServer(self.path, Handler)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        client = self.daemon.Client()
+        with self.assertRaises(self.daemon.Unavailable):
+            client.get_preview(self.path, self.url + '/one', {})
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+
+
+class ProxyTestCase(SupyTestCase):
+    """The generic and API previewers through a local stand-in proxy"""
+
+    def setUp(self):
+        super().setUp()
+        from . import proxies
+        from .previewers import generic
+        self.proxies, self.generic = proxies, generic
+        self.site = start_server(Site)
+        self.proxy = start_server(StandInProxy)
+        StandInProxy.hosts = {'public.test': self.site.server_address}
+        StandInProxy.requested = []
+        Site.routes = {
+            '/page': (200, {}, b'<title>Through the proxy</title>'
+                               b'<meta name="description" content="Hi">'),
+        }
+        self.proxy_url = 'http://127.0.0.1:%d' % self.proxy.server_address[1]
+        self.generic.preview_cache.clear()
+
+    def tearDown(self):
+        self.proxies.pool.stop()
+        self.proxies.pool.configure([], 'round-robin', 5.0, None)
+        for server in (self.site, self.proxy):
+            server.shutdown()
+            server.server_close()
+        super().tearDown()
+
+    def use_proxies(self, *urls):
+        return conf.supybot.plugins.URLpreview.proxies.context(list(urls))
+
+    def testPreview(self):
+        with self.use_proxies(self.proxy_url):
+            preview = self.generic.handle('http://public.test/page')
+        self.assertEqual(preview.title, 'Through the proxy')
+        self.assertEqual(StandInProxy.requested, ['http://public.test/page'])
+
+    def testRedirects(self):
+        Site.routes['/moved'] = (302, {'Location': 'http://public.test/page'},
+                                 b'')
+        Site.routes['/metadata'] = (
+            302, {'Location': 'http://169.254.169.254/latest/meta-data/'},
+            b'')
+        with self.use_proxies(self.proxy_url):
+            self.assertEqual(
+                self.generic.handle('http://public.test/moved').title,
+                'Through the proxy')
+            self.assertIsNone(
+                self.generic.handle('http://public.test/metadata'))
+        self.assertEqual(StandInProxy.requested, [
+            'http://public.test/moved', 'http://public.test/page',
+            'http://public.test/metadata'])
+
+    def testChecksRestart(self):
+        with self.use_proxies(self.proxy_url):
+            self.assertTrue(self.proxies.configured_pool()._thread.is_alive())
+            # Like die() and loading the plugin again
+            self.proxies.pool.stop()
+            self.assertTrue(self.proxies.configured_pool()._thread.is_alive())
+
+    def testSiteErrors(self):
+        # Blocked hosts, sites the proxy can't reach: not the proxy's fault
+        with self.use_proxies(self.proxy_url):
+            for _ in range(3):
+                self.assertIsNone(self.generic.handle('http://10.0.0.1/'))
+                self.assertIsNone(
+                    self.generic.handle('https://unreachable.test/'))
+            self.assertTrue(self.proxies.pool.proxies[0].healthy)
+
+    def testDeadProxy(self):
+        from . import api
+        self.proxy.shutdown()
+        self.proxy.server_close()
+        with self.use_proxies(self.proxy_url):
+            for _ in range(3):
+                self.assertIsNone(self.generic.handle('http://public.test/'))
+            self.assertFalse(self.proxies.pool.proxies[0].healthy)
+            # API previewers get an error response, not an exception
+            r = api.get('http://public.test/api')
+            self.assertEqual(r.status_code, 503)
+
+
+class ReplayTestCase(SupyTestCase):
+    """The previewers with the responses in testdata/previews.cassette"""
+    CASSETTE = os.path.join(os.path.dirname(__file__), 'testdata',
+                            'previews.cassette')
+
+    def setUp(self):
+        super().setUp()
+        from . import transport
+        from .previewers import generic, twitter, youtube
+        self.transport = transport
+        self.generic, self.twitter, self.youtube = generic, twitter, youtube
+        for cache in (generic.preview_cache, generic.redirect_cache,
+                      twitter.tweet_cache, twitter.user_cache,
+                      youtube.video_cache):
+            cache.clear()
+        transport.replay(self.CASSETTE)
+
+    def tearDown(self):
+        self.transport.live()
+        super().tearDown()
+
+    def testGeneric(self):
+        preview = self.generic.handle(
+            'https://news.example.com/2020/06/lake-levels')
+        self.assertEqual(preview.title,
+                         'Lake levels rise after a wet spring | '
+                         'Limnology News')
+        self.assertEqual(preview.description, "Water levels in the "
+                         "region's lakes are the highest in a decade.")
+        self.assertEqual(preview.published.year, 2020)
+
+    def testYoutube(self):
+        preview = self.youtube.preview_video('API key', 'Xq3lM9TbI8A')
+        self.assertEqual(preview.title, 'Sampling plankton through the ice')
+        self.assertEqual(preview.author, 'Lake Research Station')
+        self.assertEqual(preview.counters,
+                         {'views': 48213, 'likes': 1520, 'dislikes': 12})
+        self.assertIn('Views: \x0248,213\x02',
+                      self.youtube.format_video(preview, {}))
+
+    def testTwitter(self):
+        from .preview import Preview
+        tweet = self.twitter.get_status('1323270187462467584', 'token')
+        self.assertEqual(tweet.description,
+                         'Our new buoy is in the water! ⏎ First data '
+                         'tomorrow.')
+        self.assertEqual(tweet.username, 'lakestation')
+        self.assertTrue(tweet.has(Preview.VERIFIED))
+        profile = self.twitter.get_profile('lakestation', 'token')
+        self.assertEqual(profile.author, 'Lake Station')
+        self.assertEqual(profile.counters,
+                         {'tweets': 4821, 'followers': 15234})
+
+    def testNotRecorded(self):
+        self.assertIsNone(self.generic.handle('https://news.example.com/'))
+
+
+class FaultInjectionTestCase(SupyTestCase):
+    """Pathological pages (see benchmarks/faults.py) must not pin the
+    threads previewing them"""
+    TIMEOUT = 1
+    MAX_DOWNLOAD_TIME = 2
+    TIME_LIMIT = MAX_DOWNLOAD_TIME + 2 * TIMEOUT + 1  # per preview
+    MAX_RSS_GROWTH = 150 * 1024  # KiB
+    CONCURRENCY = 2
+
+    def setUp(self):
+        super().setUp()
+        from . import resolver
+        from .benchmarks import faults
+        from .governor import Governor
+        from .previewers import generic
+        self.faults, self.generic, self.resolver = faults, generic, resolver
+        self.saved = (resolver.BLOCK_INTERNAL, generic.TIMEOUT,
+                      generic.MAX_DOWNLOAD_TIME, generic.governor)
+        resolver.BLOCK_INTERNAL = False
+        generic.TIMEOUT = self.TIMEOUT
+        generic.MAX_DOWNLOAD_TIME = self.MAX_DOWNLOAD_TIME
+        # Time the previews themselves, not the queue for connections
+        generic.governor = Governor(max_connections=0,
+                                    per_host=self.CONCURRENCY)
+        self.servers, self.urls = faults.start_servers()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        (self.resolver.BLOCK_INTERNAL, self.generic.TIMEOUT,
+         self.generic.MAX_DOWNLOAD_TIME, self.generic.governor) = self.saved
+        super().tearDown()
+
+    def testPreviewTime(self):
+        times = self.faults.preview_all(self.urls.values(), self.CONCURRENCY,
+                                        self.TIME_LIMIT)
+        for (scenario, url) in self.urls.items():
+            self.assertLessEqual(max(times[url]), self.TIME_LIMIT, scenario)
+        self.assertEqual(self.generic.handle(self.urls['normal']).title,
+                         'Normal page')
+        self.assertEqual(self.generic.handle(self.urls['oneline']).title,
+                         'One line')
+
+    def testRecord(self):
+        import os
+        import tempfile
+        from . import transport
+        urls = [self.urls['chunked'], self.urls['normal']]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'faults.cassette')
+            with transport.cassette(path, transport.RECORD):
+                times = self.faults.preview_all(urls, 1, self.TIME_LIMIT)
+            for url in urls:
+                self.assertLessEqual(max(times[url]), self.TIME_LIMIT, url)
+            with transport.cassette(path):
+                self.assertEqual(self.generic.handle(urls[1]).title,
+                                 'Normal page')
+
+    def testResources(self):
+        import resource
+        import threading
+        import time
+        threads = threading.active_count()
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.faults.preview_all(self.urls.values(), self.CONCURRENCY,
+                                self.TIME_LIMIT)
+        # The servers' threads notice that the client is gone on their
+        # next write
+        for _ in range(20):
+            if threading.active_count() <= threads:
+                break
+            time.sleep(0.1)
+        self.assertLessEqual(threading.active_count(), threads)
+        self.assertLessEqual(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss,
+            self.MAX_RSS_GROWTH)
+
+
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
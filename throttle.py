@@ -0,0 +1,118 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Per-channel limits on what the plugin says"""
+
+from collections import deque
+import threading
+import time
+
+
+class RecentURLs:
+    """Remembers the last <size> URLs previewed per channel, in a ring
+    buffer with an index by URL"""
+
+    def __init__(self, size=64):
+        self.size = size
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def seen(self, channel, url, window):
+        """Returns True if <url> was previewed in <channel> in the last
+        <window> seconds"""
+        with self._lock:
+            (_, index) = self._channels.get(channel, (None, {}))
+            last_seen = index.get(url)
+        return last_seen is not None and \
+            time.monotonic() - last_seen < window
+
+    def record(self, channel, url):
+        """Records that <url> was just previewed in <channel>"""
+        now = time.monotonic()
+        with self._lock:
+            ring, index = self._channels.setdefault(
+                channel, (deque(), {}))
+            if len(ring) >= self.size:
+                (old_url, old_time) = ring.popleft()
+                if index.get(old_url) == old_time:
+                    del index[old_url]
+            ring.append((url, now))
+            index[url] = now
+
+    def clear(self):
+        with self._lock:
+            self._channels.clear()
+
+
+class TokenBucket:
+    """Allows <rate> events per minute, in bursts of up to <rate>"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.rate,
+                          self.tokens + (now - self.updated) * self.rate / 60)
+        self.updated = now
+
+    def available(self):
+        self._refill(time.monotonic())
+        return self.tokens >= 1
+
+    def consume(self):
+        """Takes a token, returns False if there was none"""
+        self._refill(time.monotonic())
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateLimiter:
+    """One TokenBucket per channel"""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, channel, rate):
+        bucket = self._buckets.get(channel)
+        if bucket is None or bucket.rate != rate:
+            bucket = self._buckets[channel] = TokenBucket(rate)
+        return bucket
+
+    def available(self, channel, rate):
+        with self._lock:
+            return self._bucket(channel, rate).available()
+
+    def consume(self, channel, rate):
+        with self._lock:
+            return self._bucket(channel, rate).consume()
@@ -0,0 +1,283 @@
+###
+# Copyright © Christian Baumhof 2020
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Record/replay transport
+
+All HTTP requests of the previewers go through requests sessions whose
+adapters are wrapped in transport.Adapter. Normally it just passes the
+requests on, but the responses can also be recorded into a cassette file
+and replayed later, e.g. for tests and benchmarks without internet access:
+
+    transport.record('previews.cassette')
+    …  # preview some links
+    transport.live()  # saves the cassette
+    transport.replay('previews.cassette', realtime=True)
+
+A cassette is a gzipped JSON list of interactions: the method and URL of
+the request, and the status, headers, body (as it came over the wire, i.e.
+still compressed) and latency of the response. Replays are served at full
+speed, or with the recorded latency if <realtime>. API keys in URLs are
+masked before recording, request headers aren't recorded at all.
+"""
+
+import base64
+from contextlib import contextmanager
+import gzip
+import io
+import json
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from urllib3 import HTTPResponse
+
+from URLpreview import stats
+
+LIVE = 'live'
+RECORD = 'record'
+REPLAY = 'replay'
+
+SECRET_PARAMS = {'key', 'api_key', 'access_token', 'token'}  # masked in URLs
+# Not recorded, the body is stored in full instead of in chunks
+SKIP_HEADERS = {'transfer-encoding', 'connection', 'keep-alive'}
+# Bodies are recorded up to these limits (like generic.MAX_SIZE and
+# generic.MAX_DOWNLOAD_TIME), the rest is cut off
+MAX_BODY = 1024 * 1024
+MAX_RECORD_TIME = 15
+CHUNK_SIZE = 64 * 1024
+
+_mode = LIVE
+_cassette = None
+_realtime = False
+
+
+class NotRecorded(requests.exceptions.ConnectionError):
+    """Raised on replay for requests that aren't in the cassette"""
+
+
+class Cassette:
+    def __init__(self, path):
+        self.path = path
+        self.interactions = {}  # (method, URL) -> [interaction, …]
+        self._replayed = {}     # (method, URL) -> number of replays
+        self._lock = threading.Lock()
+
+    def load(self):
+        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+            for interaction in json.load(f):
+                key = (interaction['method'], interaction['url'])
+                self.interactions.setdefault(key, []).append(interaction)
+        return self
+
+    def save(self):
+        with self._lock:
+            interactions = [interaction
+                            for recorded in self.interactions.values()
+                            for interaction in recorded]
+        with gzip.open(self.path, 'wt', encoding='utf-8') as f:
+            json.dump(interactions, f, separators=(',', ':'))
+
+    def add(self, interaction):
+        key = (interaction['method'], interaction['url'])
+        with self._lock:
+            self.interactions.setdefault(key, []).append(interaction)
+
+    def find(self, method, url):
+        """Returns the next recorded interaction for the request, repeating
+        the last one once all of them have been replayed, or None"""
+        key = (method, mask(url))
+        with self._lock:
+            recorded = self.interactions.get(key)
+            if not recorded:
+                return None
+            index = self._replayed.get(key, 0)
+            self._replayed[key] = index + 1
+            return recorded[min(index, len(recorded) - 1)]
+
+    def urls(self):
+        """Returns the recorded URLs, in the order they were recorded"""
+        return [url for (method, url) in self.interactions]
+
+
+class Adapter(BaseAdapter):
+    """Transport adapter that passes requests on to <adapter>, records them
+    or replays them, depending on the current mode"""
+
+    def __init__(self, adapter):
+        super().__init__()
+        self.adapter = adapter
+
+    def send(self, request, **kwargs):
+        # Read the mode once, it may be switched by another thread
+        mode, cassette, realtime = _mode, _cassette, _realtime
+        if mode == REPLAY:
+            return self.replay(cassette, request, realtime)
+        if mode == RECORD:
+            return self.record(cassette, request, **kwargs)
+        return self.adapter.send(request, **kwargs)
+
+    def record(self, cassette, request, **kwargs):
+        start = time.monotonic()
+        r = self.adapter.send(request, **kwargs)
+        body, complete = read_body(r.raw, start + MAX_RECORD_TIME)
+        latency = time.monotonic() - start
+        skip = SKIP_HEADERS
+        if complete:
+            r.raw.release_conn()
+        else:
+            # Don't reuse a connection with the rest of the body still on it
+            r.raw.close()
+            stats.incr('transport_truncated')
+            skip = SKIP_HEADERS | {'content-length'}
+        interaction = {
+            'method': request.method,
+            'url': mask(request.url),
+            'status': r.status_code,
+            'reason': r.reason,
+            'headers': [[name, value] for (name, value) in r.headers.items()
+                        if name.lower() not in skip],
+            'body': base64.b64encode(body).decode('ascii'),
+            'latency': round(latency, 4),
+        }
+        cassette.add(interaction)
+        stats.incr('transport_recorded')
+        return self.build_response(request, interaction)
+
+    def replay(self, cassette, request, realtime):
+        interaction = cassette.find(request.method, request.url)
+        if interaction is None:
+            raise NotRecorded('%s %s is not in %s' %
+                              (request.method, request.url, cassette.path),
+                              request=request)
+        if realtime:
+            time.sleep(interaction['latency'])
+        stats.incr('transport_replayed')
+        return self.build_response(request, interaction)
+
+    def build_response(self, request, interaction):
+        body = base64.b64decode(interaction['body'])
+        raw = HTTPResponse(
+            body=io.BytesIO(body),
+            headers=interaction['headers'],
+            status=interaction['status'],
+            reason=interaction['reason'],
+            preload_content=False,
+            decode_content=False,
+            request_method=request.method,
+            request_url=request.url,
+        )
+        return HTTPAdapter.build_response(self, request, raw)
+
+    def close(self):
+        self.adapter.close()
+
+
+def read_body(raw, deadline):
+    """Reads the body of the urllib3 response <raw> as it came over the
+    wire, up to MAX_BODY bytes and until <deadline>. Returns (body, True if
+    that was all of it)."""
+    body = bytearray()
+    while len(body) <= MAX_BODY:
+        if time.monotonic() > deadline:
+            return bytes(body), False
+        data = raw.read1(CHUNK_SIZE, decode_content=False)
+        if not data:
+            return bytes(body), True
+        body += data
+    return bytes(body[:MAX_BODY]), False
+
+
+def mask(url):
+    """Returns <url> with the values of SECRET_PARAMS replaced by *"""
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    if not any(key in SECRET_PARAMS for (key, value) in query):
+        return url
+    query = [(key, '*' if key in SECRET_PARAMS else value)
+             for (key, value) in query]
+    return urlunsplit(parts._replace(query=urlencode(query, safe=',')))
+
+
+def session(adapter=None):
+    """Returns a requests session whose requests go through an Adapter
+    wrapping <adapter> (by default a plain HTTPAdapter)"""
+    s = requests.Session()
+    adapter = Adapter(adapter if adapter is not None else HTTPAdapter())
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    return s
+
+
+def is_live():
+    return _mode == LIVE
+
+
+def record(path):
+    """Starts recording into the cassette <path>, adding to it if it
+    exists already"""
+    global _mode, _cassette
+    live()
+    try:
+        cassette = Cassette(path).load()
+    except FileNotFoundError:
+        cassette = Cassette(path)
+    _cassette, _mode = cassette, RECORD
+
+
+def replay(path, realtime=False):
+    """Starts replaying the cassette <path>, with the recorded latencies
+    if <realtime>"""
+    global _mode, _cassette, _realtime
+    live()
+    _cassette, _realtime = Cassette(path).load(), realtime
+    _mode = REPLAY
+
+
+def live():
+    """Goes back to making real requests, saving the cassette if we were
+    recording"""
+    global _mode, _cassette
+    if _mode == RECORD:
+        _cassette.save()
+    _mode, _cassette = LIVE, None
+
+
+@contextmanager
+def cassette(path, mode=REPLAY, realtime=False):
+    """Context manager that records or replays <path>"""
+    if mode == RECORD:
+        record(path)
+    else:
+        replay(path, realtime)
+    try:
+        yield _cassette
+    finally:
+        live()